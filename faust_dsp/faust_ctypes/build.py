@@ -0,0 +1,243 @@
+import os
+import glob
+import time
+import shutil
+import hashlib
+import platform
+import tempfile
+import subprocess
+import numpy as np
+
+from os import path
+
+
+ARCH_DIR = path.dirname(path.abspath(__file__))
+ARCH_FILE = path.join(ARCH_DIR, "dllarch.c")
+DEFAULT_CACHE_DIR = path.join(path.expanduser("~"), ".cache", "faust_ctypes")
+
+# build variants: (faust flags, C compiler flags)
+VARIANTS = {
+    "default": ((), ()),
+    "O3": ((), ("-O3",)),
+    "native": ((), ("-O3", "-march=native")),
+    "vec": (("-vec", "-vs", "32"), ("-O3", "-march=native")),
+    "vec-fast": (("-vec", "-vs", "64", "-ftz", "2"), ("-O3", "-march=native", "-ffast-math")),
+}
+
+
+def faust_version(faust="faust"):
+    """version string of the faust compiler (part of the cache key)
+
+    :param faust: faust executable
+    :type faust: str
+    :rtype: str
+    """
+    return subprocess.run([faust, "--version"], capture_output=True,
+                          text=True, check=True).stdout.strip()
+
+
+def host_cpu():
+    """description of the host CPU (model & instruction set extensions),
+    part of the cache key of builds tuned with ``-march=native``
+
+    :rtype: str
+    """
+    parts = [platform.machine()]
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if not line.strip():
+                    break  # first core only
+                key, _, value = line.partition(":")
+                if key.strip() in ("model name", "flags", "Features",
+                                   "CPU implementer", "CPU part"):
+                    parts.append(value.strip())
+    except OSError:
+        try:
+            parts.append(subprocess.run(
+                ["sysctl", "-n", "machdep.cpu.brand_string"],
+                capture_output=True, text=True, check=True).stdout.strip())
+        except (OSError, subprocess.CalledProcessError):
+            parts.append(platform.processor())
+    return "|".join(parts)
+
+
+def cache_key(dsp_path, faust_flags, cflags, cc="cc"):
+    """hash of everything but the faust version that affects the built
+    DLL: DSP source, architecture file, C compiler and flags, plus the host
+    CPU for ``-march=native`` / ``-mtune=native`` builds
+
+    :rtype: str
+    """
+    h = hashlib.sha256()
+    for fname in (dsp_path, ARCH_FILE):
+        with open(fname, "rb") as f:
+            h.update(f.read())
+    parts = [cc, *faust_flags, "|", *cflags]
+    if any(flag.endswith("=native") for flag in cflags):
+        parts += ["|", host_cpu()]
+    for part in parts:
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def build_dsp(dsp_path, variant="default", faust_flags=None, cflags=None,
+              cache_dir=None, faust="faust", cc="cc", force=False):
+    """compile a ``.dsp`` file to a DLL usable by :class:`Faust`, reusing a
+    cached build when DSP source, faust version and flags are unchanged
+
+    without a faust compiler on the ``PATH``, the most recent cached build
+    of the same source and flags is used, whatever faust version built it
+
+    equivalent to ``faust -lang c -A faust_ctypes -a faust_ctypes/dllarch.c``
+    followed by ``cc -fPIC -shared``
+
+    :param dsp_path: path of the Faust source
+    :type dsp_path: str or PathLike
+    :param variant: name of a preset in ``VARIANTS``
+    :type variant: str
+    :param faust_flags: (optional) faust flags, overrides the variant's
+    :type faust_flags: sequence of str
+    :param cflags: (optional) C compiler flags, overrides the variant's
+    :type cflags: sequence of str
+    :param cache_dir: (optional) where built DLLs are kept, defaults to
+                      ``$FAUST_CTYPES_CACHE`` or ``~/.cache/faust_ctypes``
+    :type cache_dir: str
+    :param force: rebuild even if cached
+    :type force: bool
+
+    :return: path of the built DLL
+    :rtype: str
+    :raise subprocess.CalledProcessError: if faust or the C compiler fails
+    :raise FileNotFoundError: if faust isn't installed and nothing is cached
+    """
+    if variant not in VARIANTS:
+        raise ValueError("unknown build variant %r, expected one of %s"
+                         % (variant, ", ".join(VARIANTS)))
+    faust_flags = tuple(VARIANTS[variant][0] if faust_flags is None
+                        else faust_flags)
+    cflags = tuple(VARIANTS[variant][1] if cflags is None else cflags)
+    if cache_dir is None:
+        cache_dir = os.environ.get("FAUST_CTYPES_CACHE", DEFAULT_CACHE_DIR)
+
+    dsp_path = path.abspath(dsp_path)
+    name = path.splitext(path.basename(dsp_path))[0]
+    # <name>-<source & flags key>-<faust version key>.so
+    prefix = "%s-%s-" % (name, cache_key(dsp_path, faust_flags, cflags, cc)[:16])
+    if shutil.which(faust) is None and not force:
+        cached = glob.glob(path.join(glob.escape(cache_dir), glob.escape(prefix) + "*.so"))
+        if cached:
+            return max(cached, key=path.getmtime)
+        raise FileNotFoundError("faust compiler %r not found and no cached "
+                                "build of %s in %s" % (faust, dsp_path, cache_dir))
+
+    version_key = hashlib.sha256(faust_version(faust).encode()).hexdigest()
+    dll_path = path.join(cache_dir, prefix + version_key[:8] + ".so")
+    if path.exists(dll_path) and not force:
+        return dll_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=cache_dir) as tmp:
+        c_path = path.join(tmp, name + ".c")
+        tmp_dll = path.join(tmp, name + ".so")
+        subprocess.run([faust, "-lang", "c", "-A", ARCH_DIR, "-a", ARCH_FILE,
+                        *faust_flags, dsp_path, "-o", c_path], check=True)
+        subprocess.run([cc, "-fPIC", "-shared", *cflags, c_path,
+                        "-o", tmp_dll, "-lm"], check=True)
+        # atomic, so concurrent builds of the same key don't clash
+        os.replace(tmp_dll, dll_path)
+
+    return dll_path
+
+
+def clear_cache(cache_dir=None):
+    """remove all cached DLLs"""
+    if cache_dir is None:
+        cache_dir = os.environ.get("FAUST_CTYPES_CACHE", DEFAULT_CACHE_DIR)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def render(dsp, n_blocks, block=1764):
+    """output of a fresh DSP instance with its default controls, as one
+    (channels, samples) array"""
+    audio_out = dsp.proc.gen_io(block, True)
+    audio_in = dsp.proc.gen_io(block)
+    out = []
+    for _ in range(n_blocks):
+        dsp.proc.compute(audio_in, audio_out)
+        out.append(audio_out.copy())
+    return np.concatenate(out, axis=1)
+
+
+def benchmark_variants(dsp_path, variants=tuple(VARIANTS), block=1764,
+                       seconds=10, sr=44100, check_seconds=1, **build_kwargs):
+    """measure the throughput of each build variant of a DSP, and how far
+    its output strays from the ``default`` build (``-ffast-math`` & ``-ftz``
+    may change results; faust's noise generators are deterministic, so any
+    difference comes from the build)
+
+    :param block: samples per ``compute`` call (default: one control step
+                  at 25 Hz, as in the data generation notebook)
+    :type block: int
+    :param seconds: seconds of audio to render per variant
+    :type seconds: float
+    :param check_seconds: seconds of audio compared against ``default``
+    :type check_seconds: float
+
+    :return: {variant: (samples per second, realtime factor, max. absolute
+             deviation from default)}, fastest first
+    :rtype: dict
+    """
+    # imported here, wrapper imports this module
+    from faust_ctypes.wrapper import Faust
+
+    results = {}
+    n_blocks = max(1, int(seconds * sr) // block)
+    n_check = max(1, int(check_seconds * sr) // block)
+    reference = render(Faust(build_dsp(dsp_path, "default", **build_kwargs), sr),
+                       n_check, block)
+    for variant in variants:
+        dll = build_dsp(dsp_path, variant, **build_kwargs)
+        deviation = float(np.max(np.abs(render(Faust(dll, sr), n_check, block)
+                                        - reference)))
+
+        dsp = Faust(dll, sr)
+        audio_out = dsp.proc.gen_io(block, True)
+        audio_in = dsp.proc.gen_io(block)
+        dsp.proc.compute(audio_in, audio_out)  # warm-up
+
+        start = time.perf_counter()
+        for _ in range(n_blocks):
+            dsp.proc.compute(audio_in, audio_out)
+        elapsed = time.perf_counter() - start
+
+        rate = n_blocks * block / elapsed
+        results[variant] = (rate, rate / sr, deviation)
+
+    return dict(sorted(results.items(), key=lambda kv: -kv[1][0]))
+
+
+def fastest_variant(dsp_path, max_deviation=None, **kwargs):
+    """name of the fastest build variant of a DSP on this machine, only
+    considering variants within ``max_deviation`` of the default build"""
+    return next(variant for variant, (_, _, deviation)
+                in benchmark_variants(dsp_path, **kwargs).items()
+                if max_deviation is None or deviation <= max_deviation)
+
+
+if __name__ == "__main__":
+    # from faust_dsp/: python -m faust_ctypes.build SF_voc_synth_m.dsp
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="build & benchmark Faust DSP variants")
+    parser.add_argument("dsp")
+    parser.add_argument("-v", "--variants", nargs="+", default=list(VARIANTS))
+    parser.add_argument("-s", "--seconds", type=float, default=10)
+    args = parser.parse_args()
+
+    for variant, (rate, rt, deviation) in benchmark_variants(
+            args.dsp, args.variants, seconds=args.seconds).items():
+        print("%10s: %12.0f samples/s  (%.1fx realtime)  max. dev. %.2e"
+              % (variant, rate, rt, deviation))
@@ -6,6 +6,7 @@ from os import path, PathLike
 from faust_ctypes.processor import Processor
 from faust_ctypes.interface import UserInterface
 from faust_ctypes.metadata import MetaData
+from faust_ctypes.build import build_dsp
 
 
 class Faust(object):
@@ -14,15 +15,23 @@ class Faust(object):
     groups processor, interface and metadata, and ensure that they are
     consistently initialized together
     """
-    def __init__(self, dll, sr=44100):
+    def __init__(self, dll, sr=44100, variant="default", **build_kwargs):
         """initialize the wrapper
 
-        :param dll: the dynamically linked library
+        :param dll: the dynamically linked library, or a ``.dsp`` file which
+                    is then built (and cached) with
+                    :func:`faust_ctypes.build.build_dsp`
         :type dll: string or file-like or ctypes.CDLL
         :param sr: the sampling rate (unused as of now)
         :type sr: int
+        :param variant: build variant for ``.dsp`` files, see
+                        ``faust_ctypes.build.VARIANTS``
+        :type variant: str
 
         """
+        if isinstance(dll, (str, PathLike)) and str(dll).endswith(".dsp"):
+            dll = build_dsp(dll, variant, **build_kwargs)
+
         if isinstance(dll, (str, bytes, PathLike, int)) and path.exists(dll):
             self.dll = c.CDLL(path.abspath(dll))
         elif isinstance(dll, c.CDLL):
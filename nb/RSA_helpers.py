@@ -1,5 +1,6 @@
 import torch
 import json
+import math
 import os
 import random
 import torchaudio.transforms as T
@@ -21,10 +22,94 @@ ONTOLOGY_PATH = '../data/audioset/ontology.json'
 N_AUDIO_FEATURES = 19
 N_VOCAL_TRACT_CONTROLS = 5
 N_GRID_SEQ_TYPE = 11
+N_EXTENDED_SEQ_TYPE = 15   # lookup_extended_grid_seq
+FEAT_LEN = 1 + (AUDIO_SR*SAMPLE_LEN//CONTROL_SR) // (FEAT_NFFT//2)   # STFT frames per utterance (centered, hop = n_fft/2)
 
 
 ### HELPER FUNCS ###
 
+# grid control sequences
+
+def lookup_grid_seq(seq_order, length, generator=None):
+    '''
+    Control sequence for a grid sequence type (same as in SF_data_gen).
+    Pass a seeded generator to make the random sequence type reproducible
+    '''
+    # constant
+    if seq_order <= 3:
+        return 0.33*seq_order*torch.ones(SAMPLE_LEN)
+
+    # sine
+    elif seq_order <= 6:
+        return 0.5 + 0.4*torch.sin(torch.linspace(0,SAMPLE_LEN//CONTROL_SR,steps=SAMPLE_LEN)*2*math.pi*(seq_order-3))
+
+    # sine biased hi
+    elif seq_order <= 7:
+        return 0.75 + 0.25*torch.sin(torch.linspace(0,SAMPLE_LEN//CONTROL_SR,steps=SAMPLE_LEN)*2*math.pi*(seq_order-5))
+
+    # sine biased low
+    elif seq_order <= 8:
+        return 0.25 + 0.25*torch.sin(torch.linspace(0,SAMPLE_LEN//CONTROL_SR,steps=SAMPLE_LEN)*2*math.pi*(seq_order-6))
+
+    # falling saw
+    elif seq_order <= 9:
+        return 1 - (torch.linspace(0, SAMPLE_LEN*(seq_order-7), steps=SAMPLE_LEN) % 1)
+
+    # random
+    elif seq_order <= 10:
+        return torch.rand(SAMPLE_LEN//3 + 3, generator=generator).repeat_interleave(3)[:SAMPLE_LEN]
+
+    raise ValueError(f"grid sequence type {seq_order} is not defined (0-10)")
+
+
+def lookup_extended_grid_seq(seq_order, length, generator=None):
+    '''
+    lookup_grid_seq plus types 11-14 (N_EXTENDED_SEQ_TYPE types), for grids beyond the rendered bank
+    '''
+    # rising ramp
+    if seq_order == 11:
+        return torch.linspace(0, 1, steps=SAMPLE_LEN)
+
+    # falling ramp
+    elif seq_order == 12:
+        return torch.linspace(1, 0, steps=SAMPLE_LEN)
+
+    # triangle
+    elif seq_order == 13:
+        return 1 - torch.abs(torch.linspace(-1, 1, steps=SAMPLE_LEN))
+
+    # step up halfway
+    elif seq_order == 14:
+        return 0.2 + 0.6*(torch.arange(SAMPLE_LEN) >= SAMPLE_LEN//2).float()
+
+    elif seq_order < N_GRID_SEQ_TYPE:
+        return lookup_grid_seq(seq_order, length, generator)
+
+    raise ValueError(f"grid sequence type {seq_order} is not defined (0-{N_EXTENDED_SEQ_TYPE - 1})")
+
+
+def grid_control_sequence(controls_tup, flat_index, seed=0, seq_fn=lookup_grid_seq):
+    '''
+    (SAMPLE_LEN, len(controls_tup)) control matrix for a grid point, e.g. (4,7,6,4,8).
+    The random sequence type is seeded per grid point (by its flat, row-major index),
+    so every caller draws the same controls for the same point
+    '''
+    generator = torch.Generator().manual_seed(seed*2**32 + int(flat_index))
+    return torch.stack([seq_fn(x, SAMPLE_LEN, generator) for x in controls_tup], dim=1)
+
+
+def grid_control_sequences(idx, flat_idx, seed=0):
+    '''
+    Batched grid_control_sequence: (batch, n_controls) grid points -> (batch, SAMPLE_LEN, n_controls)
+    '''
+    # deterministic types from one table, only points with a random control get their own draw
+    table = torch.stack([lookup_grid_seq(i, SAMPLE_LEN) for i in range(N_GRID_SEQ_TYPE - 1)] + [torch.zeros(SAMPLE_LEN)])
+    controls = table[idx].transpose(1, 2)
+    for row in torch.nonzero((idx == N_GRID_SEQ_TYPE - 1).any(1)).flatten().tolist():
+        controls[row] = grid_control_sequence(idx[row].tolist(), flat_idx[row], seed)
+    return controls
+
+
 # ontology stuff
 
 def get_ontology_dist(ontology_tree, a, b):
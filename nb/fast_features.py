@@ -0,0 +1,165 @@
+import time
+import torch
+import torch.nn.functional as F
+
+from RSA_helpers import *
+
+
+
+### FAST FEATURES ###
+
+# Same features as SimpleAudioFeatures, for a fixed AUDIO_SR*SAMPLE_LEN/CONTROL_SR
+# input: one STFT shared by all four tracks (the centroid wants magnitude, the
+# rest power), trapezoid windows & scaling constants precomputed as buffers,
+# derivatives from a single pad, and everything kept in float32 (the eager path
+# promotes to float64 via torch.mean(..., dtype=float)). Works on batches too:
+# (..., n_samples) -> (..., FEAT_LEN*N_AUDIO_FEATURES).
+#
+# NOTE: not interchangeable with SimpleAudioFeatures. The derivative-mean rows
+# (DERIV_MEAN_ROWS) come out exactly 0 here, while the eager float64 path fills
+# them with rounding residue scaled by 10**9 - which is large enough to dominate
+# the normalized vector. Features from the two extractors are only comparable
+# after zero_deriv_mean_rows on the SimpleAudioFeatures side.
+
+DERIV_MEAN_ROWS = [2, 7, 12, 17]   # deriv means of loudness, flatness, centroid, peak
+
+
+def zero_deriv_mean_rows(features):
+    '''
+    Copy of (..., FEAT_LEN*N_AUDIO_FEATURES) features with the derivative-mean rows zeroed
+    '''
+    features = features.reshape(list(features.shape[:-1]) + [N_AUDIO_FEATURES, FEAT_LEN]).clone()
+    features[..., DERIV_MEAN_ROWS, :] = 0
+    return features.flatten(-2)
+
+
+def trap_window(length, amt=10):
+    '''
+    The window trap_win_1D multiplies by
+    '''
+    window = torch.ones(length)
+    window[1:amt+1] = torch.linspace(0, 1, steps=amt)
+    window[-amt-2:-2] = torch.linspace(1, 0, steps=amt)
+    window[0] = 0
+    window[-1] = 0
+    return window
+
+
+def dist_features(seq: torch.Tensor, include_mean: bool = True) -> torch.Tensor:
+    '''
+    Batched float32 compute_dist_features
+    '''
+    padded = F.pad(seq, (1, 1))
+    deriv = (padded[..., :-2] - padded[..., 2:])/2
+
+    # centered_deriv telescopes, so its mean comes exactly from the end points
+    # (zero for trapezoid-windowed tracks; the eager float64 mean only sees rounding residue * 10**9)
+    deriv_sum = (seq[..., 0] - seq[..., -1])/2
+    stats = [torch.std(seq, dim=-1), torch.abs(deriv_sum / seq.shape[-1]) * 10**9, torch.std(deriv, dim=-1)]
+    if include_mean:
+        stats.insert(0, torch.mean(seq, dim=-1))
+
+    stats = torch.stack(stats, dim=-1).unsqueeze(-1).expand(list(seq.shape[:-1]) + [len(stats), seq.shape[-1]])
+    return torch.cat((seq.unsqueeze(-2), stats), dim=-2).flatten(-2)
+
+
+class FastAudioFeatures(torch.nn.Module):
+    '''
+    Static-shape, float32 version of SimpleAudioFeatures (see compile_feature_extractor).
+    Its derivative-mean rows are exactly 0, so don't mix its output with banks extracted by
+    SimpleAudioFeatures (U_features, S_features, ...) unless they went through zero_deriv_mean_rows
+    '''
+    def __init__(self, n_samples: int = AUDIO_SR*SAMPLE_LEN//CONTROL_SR):
+        super().__init__()
+        self.n_samples = n_samples
+        self.n_fft = FEAT_NFFT
+        self.hop = FEAT_NFFT // 2
+        n_frames = 1 + n_samples // self.hop
+
+        trap = trap_window(n_frames)
+        self.register_buffer('window', torch.hann_window(self.n_fft))
+        self.register_buffer('freqs', torch.linspace(0, AUDIO_SR // 2, steps=1 + self.n_fft // 2).unsqueeze(1))
+        self.register_buffer('loudness_win', trap * 600)
+        self.register_buffer('flatness_win', trap * 2 * 10**5)   # scaling factor on vibes
+        self.register_buffer('centroid_win', trap / AUDIO_SR * 3000)   # scaling factor on vibes
+        self.register_buffer('peak_win', trap * 3)   # scaling factor on vibes
+
+    def forward(self, waveform: torch.Tensor) -> torch.Tensor:
+        batch_shape = waveform.shape[:-1]
+        x = waveform.reshape(-1, self.n_samples).float()
+
+        mag = torch.stft(x, self.n_fft, self.hop, window=self.window, center=True,
+                         pad_mode='reflect', return_complex=True).abs()
+        power = mag*mag
+
+        loudness = F.normalize(torch.sum(power, -2), dim=-1) * self.loudness_win
+        flatness = torch.nan_to_num(torch.exp(torch.mean(torch.log(power), -2)) / torch.mean(power, -2), nan=0.0) * self.flatness_win
+        centroid = torch.sum(self.freqs*mag, -2) / torch.sum(mag, -2) * self.centroid_win
+        peak = torch.argmax(power, dim=-2).float() * self.peak_win
+
+        features = torch.cat((dist_features(loudness, False), dist_features(flatness),
+                              dist_features(centroid), dist_features(peak)), dim=-1)
+        return features.reshape(list(batch_shape) + [features.shape[-1]])
+
+
+def compile_feature_extractor(mode='script'):
+    '''
+    FastAudioFeatures compiled with TorchScript ('script'), torch.compile ('compile', needs a
+    C++ toolchain on CPU) or left eager ('eager')
+    '''
+    extractor = FastAudioFeatures().eval()
+    if mode == 'script':
+        return torch.jit.freeze(torch.jit.script(extractor))
+    elif mode == 'compile':
+        return torch.compile(extractor, dynamic=False)
+    elif mode == 'eager':
+        return extractor
+    raise ValueError(f"unknown compile mode: {mode}")
+
+
+### BENCHMARK ###
+
+@torch.no_grad()
+def benchmark_feature_extractors(modes=('eager', 'script'), batch=1, n_iters=50, n_warmup=5):
+    '''
+    Mean ms per call vs. SimpleAudioFeatures, plus deviation from it over the full feature vector:
+    max abs. difference relative to its max magnitude & min cosine between the normalized outputs,
+    both as is and with the derivative-mean rows zeroed on both sides (zero_deriv_mean_rows)
+    '''
+    n_samples = AUDIO_SR*SAMPLE_LEN//CONTROL_SR
+    waveforms = torch.randn(batch, n_samples)*0.1
+
+    reference_extractor = SimpleAudioFeatures()
+    def reference(x):
+        return torch.stack([reference_extractor(w) for w in x])
+
+    extractors = {'SimpleAudioFeatures': reference}
+    for mode in modes:
+        extractors[f'fast ({mode})'] = compile_feature_extractor(mode)
+
+    expected = torch.nan_to_num(reference(waveforms).float())
+
+    results = {}
+    for name, extractor in extractors.items():
+        for _ in range(n_warmup):
+            out = extractor(waveforms)
+        start = time.perf_counter()
+        for _ in range(n_iters):
+            out = extractor(waveforms)
+        elapsed = (time.perf_counter() - start)/n_iters*1000
+
+        dtype = out.dtype
+        out = torch.nan_to_num(out.float())
+        err = torch.abs(out - expected).max() / expected.abs().max()
+        cos = torch.sum(F.normalize(out, dim=-1)*F.normalize(expected, dim=-1), -1).min()
+        cos_zeroed = torch.sum(F.normalize(zero_deriv_mean_rows(out), dim=-1)*F.normalize(zero_deriv_mean_rows(expected), dim=-1), -1).min()
+        results[name] = {'ms': elapsed, 'rel_err': err.item(), 'cosine': cos.item(), 'cosine_zeroed': cos_zeroed.item(), 'dtype': str(dtype)}
+        print(f"{name:>24}: {elapsed:8.2f} ms / batch of {batch}   rel. err {err.item():.2e}   "
+              f"cos {cos.item():.6f} ({cos_zeroed.item():.6f} zeroed)   {dtype}")
+
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_feature_extractors()
+    benchmark_feature_extractors(batch=16)
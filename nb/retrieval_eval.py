@@ -0,0 +1,237 @@
+import os
+import csv
+import json
+import math
+import argparse
+import numpy as np
+import torch
+
+from RSA_helpers import *
+
+
+
+### GLOBALS ###
+VI_DIR = '../data/vocal_imitations/'
+VI_TO_CAT_PATH = '../data/vocal_imitations/categories.csv'
+VI_FEATURES_PATH = '../data/vocal_imitations/vi_audio_features.pt'
+VI_NAMES_PATH = '../data/vocal_imitations/vi_audio_features_names.json'   # row order of VI_FEATURES_PATH
+ONT_DIST_PENALTY = 0.8
+EVAL_CHUNK_SIZE = 1024
+
+
+### DATA ###
+
+def load_vi_categories(path=VI_TO_CAT_PATH):
+    '''
+    Vocal imitation filename -> most specific category (same as find_all_vi_categories)
+    '''
+    vi_to_category = {}
+    with open(path, newline='') as csvfile:
+        reader = csv.reader(csvfile, delimiter=',')
+        next(reader, None)  # skip header
+        for row in reader:
+            vi_to_category[row[1]] = [x for x in row[3:9] if x][-1]
+    return vi_to_category
+
+
+def load_vi_names(names_path=VI_NAMES_PATH, vi_dir=VI_DIR, n_rows=None):
+    '''
+    Filename of every row of vi_audio_features.pt. Uses the names saved next to the features
+    if present, else re-lists vi_dir like extract_all_vi_features did - only valid on the same
+    filesystem, since os.listdir order isn't guaranteed
+    '''
+    if os.path.isfile(names_path):
+        with open(names_path) as f:
+            names = json.load(f)
+    else:
+        names = [d for d in os.listdir(vi_dir) if (os.path.isfile(os.path.join(vi_dir, d)) and d[-4:]=='.wav')]
+
+    if n_rows is not None and len(names) != n_rows:
+        raise ValueError(f"{len(names)} vocal imitation names for {n_rows} feature rows; re-run extract_all_vi_features to save {names_path}")
+    return names
+
+
+def load_vi_queries(features_path=VI_FEATURES_PATH, names_path=VI_NAMES_PATH, categories_path=VI_TO_CAT_PATH, vi_dir=VI_DIR):
+    '''
+    (features, categories, names) of the vocal imitations, aligned by filename.
+    Imitations without a row in categories.csv are dropped
+    '''
+    features = torch.load(features_path, weights_only=True)
+    names = load_vi_names(names_path, vi_dir, features.shape[0])
+    vi_to_category = load_vi_categories(categories_path)
+
+    rows, categories, kept = [], [], []
+    for i, name in enumerate(names):
+        category = vi_to_category.get(name, vi_to_category.get(os.path.splitext(name)[0]))
+        if category is not None:
+            rows.append(i)
+            categories.append(category)
+            kept.append(name)
+    if not rows:
+        raise ValueError(f"none of the {len(names)} vocal imitations are listed in {categories_path}")
+    return features[rows], categories, kept
+
+
+def mapped_utterance_bank(U_features, ref_to_ut, shape=(N_GRID_SEQ_TYPE,)*N_VOCAL_TRACT_CONTROLS):
+    '''
+    (features, categories) of the utterances chosen in an RSA run (ref_ut_mapping.npy rows of [category, utterance ID])
+    '''
+    U_flat = torch.reshape(U_features, (-1, U_features.shape[-1]))
+    strides = [math.prod(shape[i + 1:]) for i in range(len(shape))]
+    idx = torch.tensor([sum(int(x)*s for x, s in zip(ut.split('-'), strides)) for _, ut in ref_to_ut])
+    return U_flat[idx], [str(cat) for cat, _ in ref_to_ut]
+
+
+### HIERARCHY LOOKUP ###
+
+class HierarchyLookup(object):
+    '''
+    Breadcrumbs of a fixed set of categories, resolved once with find_key & stored as a
+    padded (n_categories, depth) tensor of node ids - padded with the leaf, so any level
+    past a category's depth is the category itself. Categories find_key can't place only
+    get ROOT as a placeholder path & are flagged in `resolved` / listed in `unresolved`;
+    they'd all "match" each other, so evaluate_retrieval drops them.
+    '''
+    def __init__(self, tree, categories):
+        self.categories = sorted(set(categories))
+        self.cat_index = {c: i for i, c in enumerate(self.categories)}
+
+        found = [find_key(tree, c, []) for c in self.categories]
+        self.resolved = torch.tensor([bool(p) for p in found])
+        self.unresolved = [c for c, p in zip(self.categories, found) if not p]
+        paths = [p or [tree["id"]] for p in found]
+        self.nodes = sorted(set(n for p in paths for n in p))
+        nodes = {n: i for i, n in enumerate(self.nodes)}
+        self.depth = max(len(p) for p in paths)
+        self.paths = torch.tensor([[nodes[n] for n in p] + [nodes[p[-1]]]*(self.depth - len(p)) for p in paths])
+        self.lengths = torch.tensor([len(p) for p in paths])
+
+        # pairwise distances: steps from each category up to the deepest shared ancestor (cf. get_ontology_dist)
+        same = (self.paths.unsqueeze(1) == self.paths.unsqueeze(0))
+        position = torch.arange(self.depth)
+        same &= (position < self.lengths.view(-1, 1, 1)) & (position < self.lengths.view(1, -1, 1))
+        shared = torch.cumprod(same.int(), dim=2).sum(2)
+        self.dists = self.lengths.view(-1, 1) + self.lengths.view(1, -1) - 2*shared
+
+    def index(self, categories):
+        return torch.tensor([self.cat_index[c] for c in categories])
+
+    def level(self, level):
+        '''
+        Node id at a tree level (0 = ROOT, 1 = top-level categories, ...) for every category
+        '''
+        return self.paths[:, min(level, self.depth - 1)]
+
+
+def category_groups(tree, categories, level=1):
+    '''
+    Ancestor at a tree level (the category itself if it's shallower or not in the tree) for every entry of categories
+    '''
+    lookup = HierarchyLookup(tree, categories)
+    idx = lookup.index(categories)
+    return [lookup.nodes[n] if lookup.resolved[i] else c
+            for c, i, n in zip(categories, idx.tolist(), lookup.level(level)[idx].tolist())]
+
+
+def category_marginals(groups, idx, sims):
+    '''
+    Similarity mass of the hits idx (with scores sims) per group, normalized to sum to 1
+    '''
+    marginals = {}
+    for i, s in zip(idx, sims):
+        marginals[groups[i]] = marginals.get(groups[i], 0.0) + s
+    total = sum(marginals.values())
+    return {k: v/total for k, v in marginals.items()} if total else marginals
+
+
+### EVALUATION ###
+
+def evaluate_retrieval(query_features, query_categories, bank_features, bank_categories, lookup,
+                       ks=(1, 5, 10), levels=None, penalty=ONT_DIST_PENALTY, chunk_size=EVAL_CHUNK_SIZE):
+    '''
+    Score all queries against the bank in batches. Per tree level: top-k accuracy, mean rank
+    & MRR of the first bank entry in the query's category at that level. Plus the mean
+    ontology distance of the top hit & exp(-penalty*dist)-weighted precision@k.
+    Queries & bank entries whose category isn't in the tree are dropped (and counted)
+    '''
+    if levels is None:
+        levels = range(1, lookup.depth)
+    levels = list(levels)
+    q_idx = lookup.index(query_categories)
+    b_idx = lookup.index(bank_categories)
+
+    q_keep, b_keep = lookup.resolved[q_idx], lookup.resolved[b_idx]
+    if not q_keep.any() or not b_keep.any():
+        raise ValueError(f"no queries or bank entries left with categories in the tree; unresolved: {lookup.unresolved}")
+    query_features, q_idx = query_features[q_keep], q_idx[q_keep]
+    bank_features, b_idx = bank_features[b_keep], b_idx[b_keep]
+    level_nodes = [lookup.level(level) for level in levels]
+    k_max = min(max(ks), bank_features.shape[0])
+
+    ranks = [[] for _ in levels]
+    top_dists = []
+    for start in range(0, query_features.shape[0], chunk_size):
+        q = q_idx[start:start + chunk_size]
+        sims = torch.nan_to_num(query_features[start:start + chunk_size] @ bank_features.T)
+        order = torch.argsort(sims, dim=1, descending=True)
+        ranked_cats = b_idx[order]
+
+        for i, nodes in enumerate(level_nodes):
+            match = nodes[ranked_cats] == nodes[q].unsqueeze(1)
+            first = torch.argmax(match.int(), dim=1) + 1
+            ranks[i].append(torch.where(match.any(1), first, bank_features.shape[0] + 1))
+
+        top_dists.append(lookup.dists[q.unsqueeze(1), ranked_cats[:, :k_max]])
+
+    top_dists = torch.cat(top_dists).float()
+    report = {
+        'n_queries': query_features.shape[0],
+        'n_dropped_queries': int((~q_keep).sum()),
+        'n_dropped_bank': int((~b_keep).sum()),
+        'unresolved_categories': sorted(set(lookup.unresolved) & (set(query_categories) | set(bank_categories))),
+        'levels': {},
+    }
+    for level, level_ranks in zip(levels, ranks):
+        level_ranks = torch.cat(level_ranks).float()
+        report['levels'][level] = dict(
+            {f'top{k}': (level_ranks <= k).float().mean().item() for k in ks},
+            mean_rank=level_ranks.mean().item(),
+            mrr=(1/level_ranks).mean().item(),
+        )
+
+    report['ont_dist_top1'] = top_dists[:, 0].mean().item()
+    for k in ks:
+        report[f'weighted_p@{k}'] = torch.exp(-penalty*top_dists[:, :k]).mean().item()
+    return report
+
+
+def evaluate_vi_retrieval(U_path='../data/vocal_synth/U_features_raw.pt', mapping_path='../data/pickles/ref_ut_mapping.npy',
+                          features_path=VI_FEATURES_PATH, names_path=VI_NAMES_PATH, categories_path=VI_TO_CAT_PATH,
+                          vi_dir=VI_DIR, **kwargs):
+    '''
+    Vocal imitations (queries) vs the utterances an RSA run mapped to each referent (bank)
+    '''
+    query_features, query_categories, _ = load_vi_queries(features_path, names_path, categories_path, vi_dir)
+
+    U_features = torch.nn.functional.normalize(torch.load(U_path, weights_only=True), dim=-1)
+    bank_features, bank_categories = mapped_utterance_bank(U_features, np.load(mapping_path))
+
+    lookup = HierarchyLookup(build_ontology_tree(), query_categories + bank_categories)
+    return evaluate_retrieval(query_features, query_categories, bank_features, bank_categories, lookup, **kwargs)
+
+
+if __name__ == '__main__':
+    # from nb/: python retrieval_eval.py
+    parser = argparse.ArgumentParser(description='vocal imitation -> RSA utterance retrieval metrics')
+    parser.add_argument('--U-path', default='../data/vocal_synth/U_features_raw.pt')
+    parser.add_argument('--mapping', default='../data/pickles/ref_ut_mapping.npy')
+    parser.add_argument('--vi-features', default=VI_FEATURES_PATH)
+    parser.add_argument('--vi-names', default=VI_NAMES_PATH)
+    parser.add_argument('--categories', default=VI_TO_CAT_PATH)
+    parser.add_argument('--vi-dir', default=VI_DIR)
+    parser.add_argument('-k', '--ks', type=int, nargs='+', default=[1, 5, 10])
+    args = parser.parse_args()
+
+    report = evaluate_vi_retrieval(args.U_path, args.mapping, args.vi_features, args.vi_names, args.categories,
+                                   args.vi_dir, ks=args.ks)
+    print(json.dumps(report, indent=2))
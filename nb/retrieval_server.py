@@ -0,0 +1,323 @@
+import time
+import json
+import base64
+import binascii
+import asyncio
+import argparse
+import collections
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torchaudio.transforms as T
+
+from RSA_helpers import *
+from fast_features import FastAudioFeatures, zero_deriv_mean_rows
+from retrieval_eval import mapped_utterance_bank, category_groups, category_marginals
+
+
+
+### GLOBALS ###
+U_FEATURES_PATH = '../data/vocal_synth/U_features_raw.pt'
+REF_UT_MAPPING_PATH = '../data/pickles/ref_ut_mapping.npy'
+SERVER_PORT = 8765
+NOISE_EPS = 1e-15
+# accepted input rates; each one keeps a T.Resample, whose kernel grows with the reduced
+# rates (sr, AUDIO_SR)/gcd - an arbitrary rate like 44101 would need a multi-GB kernel
+INPUT_SRS = (8_000, 11_025, 16_000, 20_000, 22_050, 24_000, 32_000, 44_100, 48_000, 88_200, 96_000)
+
+
+### RETRIEVAL SERVER ###
+
+# Loads the banks once and answers imitation -> referent queries over a local
+# socket (one JSON object per line). Requests arriving within window_ms of
+# each other are coalesced: one batched feature extraction for all audio
+# queries, one similarity matmul for the whole batch. Requests pipelined on one
+# connection are read ahead (up to max_batch in flight) so they can share a
+# batch too; responses come back in request order.
+#
+# Audio queries go through FastAudioFeatures, whose derivative-mean rows are
+# exactly 0, while the banks were extracted with SimpleAudioFeatures. So the
+# bank and "features" queries get those rows zeroed too (zero_deriv_mean_rows)
+# before normalizing, and all three live in the same space.
+#
+# request:  {"id": ..., "audio": <base64 float32>, "sr": 20000} or {"id": ..., "features": [...]}
+#           {"op": "stats"} for the latency / throughput counters
+# response: {"id": ..., "top": [[category, score], ...], "categories": {category: prob}}
+#           {"id": ..., "error": "..."} if that request was malformed; the connection stays open
+
+def encode_audio(waveform):
+    return base64.b64encode(np.asarray(waveform, dtype='<f4').tobytes()).decode()
+
+
+def decode_audio(payload):
+    try:
+        raw = base64.b64decode(payload, validate=True)
+    except (binascii.Error, TypeError) as e:
+        raise ValueError(f"audio is not valid base64: {e}")
+    if not raw or len(raw) % 4:
+        raise ValueError(f"audio must be a non-empty float32 buffer, got {len(raw)} bytes")
+    return torch.from_numpy(np.frombuffer(raw, dtype='<f4').copy())
+
+
+class RetrievalServer(object):
+    def __init__(self, bank_features, bank_categories, ont_tree=None, tree_level=1,
+                 top_k=10, max_batch=32, window_ms=5.0):
+        self.bank_features = F.normalize(zero_deriv_mean_rows(torch.nan_to_num(bank_features.float())), dim=-1)
+        self.bank_categories = list(bank_categories)
+        self.top_k = min(top_k, len(self.bank_categories))
+        self.max_batch = max_batch
+        self.window = window_ms / 1000
+
+        # category of each bank entry at tree_level, for marginals
+        self.bank_groups = category_groups(ont_tree, self.bank_categories, tree_level) if ont_tree is not None else None
+
+        self.feature_extractor = FastAudioFeatures().eval()
+        self.resamplers = {}
+        self.queue = None
+
+        # counters
+        self.n_requests = 0
+        self.n_batches = 0
+        self.n_errors = 0
+        self.latencies = collections.deque(maxlen=10_000)
+        self.started = time.perf_counter()
+
+    @classmethod
+    def from_files(cls, U_path=U_FEATURES_PATH, mapping_path=REF_UT_MAPPING_PATH, **kwargs):
+        U_features = F.normalize(torch.load(U_path, weights_only=True), dim=-1)
+        bank_features, bank_categories = mapped_utterance_bank(U_features, np.load(mapping_path))
+        return cls(bank_features, bank_categories, ont_tree=build_ontology_tree(), **kwargs)
+
+    # batched compute
+
+    def validate(self, request):
+        '''
+        Decode & check one request before it joins a batch; raises ValueError if it's malformed
+        '''
+        if not isinstance(request, dict):
+            raise ValueError("request must be a JSON object")
+
+        if 'audio' in request:
+            sr = request.get('sr', AUDIO_SR)
+            if not isinstance(sr, int) or isinstance(sr, bool) or sr not in INPUT_SRS:
+                raise ValueError(f"sr must be one of {INPUT_SRS}, got {sr!r}")
+            waveform = decode_audio(request['audio'])
+            if not torch.all(torch.isfinite(waveform)):
+                raise ValueError("audio contains NaN or inf samples")
+            return {'id': request.get('id'), 'audio': waveform, 'sr': sr}
+
+        if 'features' in request:
+            try:
+                features = torch.tensor(request['features'], dtype=torch.float)
+            except (TypeError, ValueError, RuntimeError) as e:
+                raise ValueError(f"features must be a list of numbers: {e}")
+            if features.shape != (self.bank_features.shape[1],):
+                raise ValueError(f"features must have length {self.bank_features.shape[1]}, got shape {list(features.shape)}")
+            if not torch.all(torch.isfinite(features)):
+                raise ValueError("features contain NaN or inf")
+            return {'id': request.get('id'), 'features': features}
+
+        raise ValueError('request needs "audio" or "features"')
+
+    def _prepare_audio(self, waveform, sr):
+        # same preprocessing as extract_all_vi_features; at most len(INPUT_SRS) resamplers
+        n_samples = AUDIO_SR*SAMPLE_LEN//CONTROL_SR
+        if sr != AUDIO_SR:
+            if sr not in self.resamplers:
+                self.resamplers[sr] = T.Resample(sr, AUDIO_SR)
+            waveform = self.resamplers[sr](waveform)
+        waveform = waveform.repeat(-(-n_samples // max(waveform.shape[0], 1)))[:n_samples]
+        return waveform + torch.randn(n_samples)*NOISE_EPS
+
+    @torch.no_grad()
+    def process_batch(self, requests):
+        '''
+        Validated requests (see validate) -> responses, with one feature extraction & one matmul for the whole batch
+        '''
+        features = torch.zeros((len(requests), self.bank_features.shape[1]))
+        audio_rows = [i for i, r in enumerate(requests) if 'audio' in r]
+        if audio_rows:
+            audio = torch.stack([self._prepare_audio(requests[i]['audio'], requests[i]['sr']) for i in audio_rows])
+            features[audio_rows] = self.feature_extractor(audio)
+        feature_rows = [i for i, r in enumerate(requests) if 'features' in r]
+        if feature_rows:
+            features[feature_rows] = zero_deriv_mean_rows(torch.stack([requests[i]['features'] for i in feature_rows]))
+
+        features = F.normalize(torch.nan_to_num(features), dim=-1)
+        top_sims, top_idx = torch.topk(features @ self.bank_features.T, self.top_k, dim=1)
+
+        responses = []
+        for r, sims, idx in zip(requests, top_sims.tolist(), top_idx.tolist()):
+            response = {'id': r.get('id'), 'top': [[self.bank_categories[i], s] for i, s in zip(idx, sims)]}
+            if self.bank_groups is not None:
+                response['categories'] = category_marginals(self.bank_groups, idx, sims)
+            responses.append(response)
+        return responses
+
+    def _process_one(self, request):
+        # fallback if a batch fails anyway, so only the offending request gets the error
+        try:
+            return self.process_batch([request])[0]
+        except Exception as e:
+            self.n_errors += 1
+            return {'id': request['id'], 'error': str(e)}
+
+    # asyncio plumbing
+
+    async def _batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            requests = [request for request, _, _ in batch]
+            try:
+                responses = await loop.run_in_executor(None, self.process_batch, requests)
+            except Exception:
+                responses = [await loop.run_in_executor(None, self._process_one, r) for r in requests]
+
+            self.n_batches += 1
+            now = time.perf_counter()
+            for (_, future, received), response in zip(batch, responses):
+                self.latencies.append(now - received)
+                if not future.done():
+                    future.set_result(response)
+
+    async def _respond(self, line):
+        request = None
+        try:
+            request = json.loads(line)
+            if isinstance(request, dict) and request.get('op') == 'stats':
+                return self.stats()
+            query = self.validate(request)
+            self.n_requests += 1
+            future = asyncio.get_running_loop().create_future()
+            await self.queue.put((query, future, time.perf_counter()))
+            return await future
+        except ValueError as e:
+            # includes JSON & UTF-8 decode errors
+            self.n_errors += 1
+            return {'id': request.get('id') if isinstance(request, dict) else None, 'error': str(e)}
+
+    async def _handle(self, reader, writer):
+        # read ahead: every line is queued right away, a writer task answers them in order
+        pending = asyncio.Queue(maxsize=self.max_batch)
+
+        async def write_responses():
+            while (task := await pending.get()) is not None:
+                writer.write((json.dumps(await task) + '\n').encode())
+                await writer.drain()
+
+        async def enqueue(item):
+            # don't block on a full queue once the writer is gone (e.g. the client disconnected)
+            put = asyncio.ensure_future(pending.put(item))
+            await asyncio.wait((put, responder), return_when=asyncio.FIRST_COMPLETED)
+            put.cancel()
+
+        responder = asyncio.create_task(write_responses())
+        try:
+            while not responder.done() and (line := await reader.readline()):
+                await enqueue(asyncio.create_task(self._respond(line)))
+            await enqueue(None)
+            await responder
+        finally:
+            responder.cancel()
+            writer.close()
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        def percentile(p):
+            return latencies[min(int(p*len(latencies)), len(latencies) - 1)]*1000 if latencies else None
+
+        return {
+            'requests': self.n_requests,
+            'batches': self.n_batches,
+            'errors': self.n_errors,
+            'mean_batch_size': self.n_requests / self.n_batches if self.n_batches else None,
+            'p50_ms': percentile(0.5),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+            'throughput_rps': self.n_requests / (time.perf_counter() - self.started),
+        }
+
+    async def serve(self, host='127.0.0.1', port=SERVER_PORT):
+        self.queue = asyncio.Queue()
+        self.started = time.perf_counter()
+        batcher = asyncio.create_task(self._batcher())
+        server = await asyncio.start_server(self._handle, host, port)
+        print(f"serving {len(self.bank_categories)} bank entries on {host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+### LOAD GENERATOR ###
+
+async def load_generator(host='127.0.0.1', port=SERVER_PORT, n_requests=1000, concurrency=16, sr=20_000, clip_sec=1.0):
+    '''
+    Hammer a running server with random audio queries from `concurrency` connections;
+    returns client-side latencies & the server's counters
+    '''
+    payload = encode_audio(torch.randn(int(sr*clip_sec))*0.1)
+    latencies = []
+
+    async def client(n):
+        reader, writer = await asyncio.open_connection(host, port)
+        for i in range(n):
+            sent = time.perf_counter()
+            writer.write((json.dumps({'id': i, 'audio': payload, 'sr': sr}) + '\n').encode())
+            await writer.drain()
+            json.loads(await reader.readline())
+            latencies.append(time.perf_counter() - sent)
+        writer.close()
+        await writer.wait_closed()
+
+    start = time.perf_counter()
+    per_client = [n_requests // concurrency + (i < n_requests % concurrency) for i in range(concurrency)]
+    await asyncio.gather(*(client(n) for n in per_client if n))
+    elapsed = time.perf_counter() - start
+
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b'{"op": "stats"}\n')
+    await writer.drain()
+    server_stats = json.loads(await reader.readline())
+    writer.close()
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'throughput_rps': len(latencies) / elapsed,
+        'p50_ms': latencies[len(latencies)//2]*1000,
+        'p95_ms': latencies[int(0.95*(len(latencies) - 1))]*1000,
+        'server': server_stats,
+    }
+
+
+if __name__ == '__main__':
+    # python retrieval_server.py serve            (from nb/)
+    # python retrieval_server.py bench -n 2000 -c 32
+    parser = argparse.ArgumentParser(description='local micro-batching retrieval server')
+    parser.add_argument('mode', choices=['serve', 'bench'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--window-ms', type=float, default=5.0)
+    parser.add_argument('--max-batch', type=int, default=32)
+    parser.add_argument('-n', '--n-requests', type=int, default=1000)
+    parser.add_argument('-c', '--concurrency', type=int, default=16)
+    args = parser.parse_args()
+
+    if args.mode == 'serve':
+        server = RetrievalServer.from_files(window_ms=args.window_ms, max_batch=args.max_batch)
+        asyncio.run(server.serve(args.host, args.port))
+    else:
+        print(json.dumps(asyncio.run(load_generator(args.host, args.port, args.n_requests, args.concurrency)), indent=2))
@@ -0,0 +1,114 @@
+import torch
+
+from RSA_helpers import *
+
+
+
+### GLOBALS ###
+RSA_CHUNK_SIZE = 8192   # utterance rows per chunk for normalization & utility propagation
+
+
+### LOG-SPACE RSA ###
+
+# Everything here works on a single (utterances, referents) matrix of log
+# probabilities, updated in place; only per-row/per-column normalizers and
+# RSA_CHUNK_SIZE-row blocks (incl. the exp temporaries of logsumexp) are
+# allocated on top of it, so deeper recursion costs time but no extra memory.
+# Axes follow the notebooks: listeners normalize over utterances (dim 0),
+# speakers over referents (dim 1).
+
+def log_normalize_(log_w, dim, chunk_size=RSA_CHUNK_SIZE):
+    '''
+    In-place logsumexp normalization along dim (0 or 1), chunked over rows so the
+    exp temporaries stay chunk-sized; all -inf slices stay -inf (instead of NaN)
+    '''
+    if dim == 1:
+        for start in range(0, log_w.shape[0], chunk_size):
+            block = log_w[start:start + chunk_size]
+            lse = torch.logsumexp(block, 1, keepdim=True)
+            block.sub_(lse.masked_fill_(torch.isinf(lse), 0))
+        return log_w
+
+    # dim 0: running max & rescaled running sum-exp per column over row chunks
+    col_max = torch.full((1, log_w.shape[1]), -float('inf'), dtype=log_w.dtype, device=log_w.device)
+    col_sum = torch.zeros((1, log_w.shape[1]), dtype=log_w.dtype, device=log_w.device)
+    for start in range(0, log_w.shape[0], chunk_size):
+        block = log_w[start:start + chunk_size]
+        new_max = torch.maximum(col_max, torch.amax(block, 0, keepdim=True))
+        shift = new_max.masked_fill(torch.isinf(new_max), 0)
+        col_sum.mul_(torch.exp(col_max - shift)).add_(torch.sum(torch.exp(block - shift), 0, keepdim=True))
+        col_max = new_max
+
+    shift = col_max.masked_fill(torch.isinf(col_max), 0)
+    lse = col_sum.log_().add_(shift)
+    return log_w.sub_(lse.masked_fill_(torch.isinf(lse), 0))
+
+
+def to_log_meaning_(meaning):
+    '''
+    Cosine meaning matrix -> log space, in place. Non-positive / NaN scores get probability 0
+    '''
+    return meaning.nan_to_num_(0.0).clamp_(min=0).log_()
+
+
+def propagate_utility_(log_w, kernel, chunk_size=RSA_CHUNK_SIZE):
+    '''
+    In place log(exp(log_w) @ kernel), chunked over utterance rows.
+    kernel: (referents, referents), e.g. exp(-ONT_DIST_PENALTY*cross_ref_dists)
+    '''
+    for start in range(0, log_w.shape[0], chunk_size):
+        block = log_w[start:start + chunk_size]
+        block.copy_(torch.mm(block.exp(), kernel).log_())
+    return log_w
+
+
+def run_rsa(meaning, depth=1, alpha=1.0, kernel=None, costs=None, cost_factor=0.0,
+            inplace=False, chunk_size=RSA_CHUNK_SIZE):
+    '''
+    Iterated RSA in log space: L0, then `depth` alternating levels S1, L1, S2, ...
+    (depth=1 is the notebooks' pragmatic_speaker, depth=2 their pragmatic_listener).
+
+    :param meaning: (utterances, referents) cosine similarities
+    :param alpha: speaker rationality
+    :param kernel: optional (referents, referents) utility kernel applied before every speaker step
+    :param costs: optional per-utterance costs (U_costs, any shape with one entry per utterance);
+                  subtracted as cost_factor*costs after each speaker normalization (before it - or in a
+                  renormalization after it - they'd cancel, since they're constant along each row)
+    :param inplace: reuse `meaning` as the working matrix instead of copying it
+    :return: (utterances, referents) log probabilities of the last level. If that's a speaker level
+             with costs, they're unnormalized log scores (log probabilities - cost_factor*costs):
+             fine for argmax over utterances, but rows no longer sum to 1
+    '''
+    log_w = meaning if inplace else meaning.clone()
+    to_log_meaning_(log_w)
+
+    if costs is not None:
+        costs = torch.reshape(costs, (-1, 1)).to(log_w)
+
+    # literal listener
+    log_normalize_(log_w, 0, chunk_size)
+
+    for level in range(1, depth + 1):
+        if level % 2:
+            # speaker
+            if kernel is not None:
+                propagate_utility_(log_w, kernel, chunk_size)
+            if alpha != 1.0:
+                log_w.mul_(alpha)
+            log_normalize_(log_w, 1, chunk_size)
+            if costs is not None and cost_factor:
+                log_w.sub_(cost_factor*costs)
+        else:
+            # listener
+            log_normalize_(log_w, 0, chunk_size)
+
+    return log_w
+
+
+def best_utterances(log_w, shape=(N_GRID_SEQ_TYPE,)*N_VOCAL_TRACT_CONTROLS):
+    '''
+    Best utterance ID (e.g. '4-7-6-4-8') for every referent
+    '''
+    best = torch.argmax(log_w, dim=0)
+    locs = torch.stack(torch.unravel_index(best, shape), dim=1)
+    return ['-'.join(map(str, loc.tolist())) for loc in locs]
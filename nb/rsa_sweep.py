@@ -0,0 +1,118 @@
+import itertools
+import torch
+
+from RSA_helpers import *
+
+
+
+### GLOBALS ###
+SWEEP_CHUNK_SIZE = 1024   # scores are (settings, chunk, referents), so smaller than RSA_CHUNK_SIZE
+
+
+### RSA SWEEP ###
+
+# Tuning ONT_DIST_PENALTY / COST_FACTOR / the referent subset used to mean
+# editing a cell and rerunning calculate_utility from scratch. The literal
+# listener and raw ontology distances don't depend on any of them, so we
+# compute those once and evaluate every (penalty, subset) kernel in a single
+# GEMM per utterance chunk: [K_1 | K_2 | ...] stacked along columns. Cost
+# factors only shift the final speaker scores, so they're a cheap inner loop
+# (one factor at a time, to keep the score block at (kernels, referents, chunk)).
+#
+# The feature scaling constants change the meaning matrix itself, so sweeping
+# them means one RSASweep per feature setting.
+
+class RSASweep(object):
+    '''
+    Cached parameter-independent RSA intermediates + batched evaluation of settings
+    '''
+    def __init__(self, meaning, cross_ref_dists, costs=None):
+        # normalized meaning -> literal listener (as in calculate_utility)
+        meaning = torch.nan_to_num(meaning)
+        self.literal_listener = torch.nan_to_num(meaning / torch.sum(meaning, 0, keepdim=True))
+        self.cross_ref_dists = cross_ref_dists
+        self.costs = torch.reshape(costs, (-1,)) if costs is not None else None
+        self.n_referents = meaning.shape[1]
+
+    def kernels(self, penalties, subsets):
+        '''
+        (n_referents, n_settings*n_referents) stacked exp(-penalty*dist) kernels, masked to each referent subset
+        '''
+        blocks = []
+        for penalty, subset in itertools.product(penalties, subsets):
+            kernel = torch.exp(-penalty*self.cross_ref_dists)
+            if subset is not None:
+                mask = torch.zeros(self.n_referents)
+                mask[subset] = 1
+                kernel = kernel * mask.unsqueeze(0) * mask.unsqueeze(1)
+            blocks.append(kernel)
+        return torch.cat(blocks, dim=1)
+
+    def run(self, penalties=(0.8,), cost_factors=(0.0,), subsets=(None,), k=10, chunk_size=SWEEP_CHUNK_SIZE):
+        '''
+        Top-k utterances per referent for every (penalty, subset, cost factor).
+        Returns (settings, top_idx) with top_idx: (n_settings, n_referents, k)
+        '''
+        if self.costs is None and len(cost_factors) > 1:
+            raise ValueError(f"{len(cost_factors)} cost factors but no costs: every cost factor would give the same setting")
+        kernels = self.kernels(penalties, subsets)
+        n_kernels = len(penalties)*len(subsets)
+        n_cf = len(cost_factors)
+
+        top_vals = [torch.full((n_kernels, self.n_referents, 0), -float('inf')) for _ in cost_factors]
+        top_idx = [torch.zeros((n_kernels, self.n_referents, 0), dtype=torch.long) for _ in cost_factors]
+
+        for start in range(0, self.literal_listener.shape[0], chunk_size):
+            block = self.literal_listener[start:start + chunk_size]
+            n_rows = block.shape[0]
+
+            # one GEMM for all kernels, then pragmatic speaker normalization per kernel
+            utility = torch.reshape(block @ kernels, (n_rows, n_kernels, self.n_referents))
+            # (n_kernels, n_referents, n_rows)
+            speaker = torch.nan_to_num(utility / torch.sum(utility, 2, keepdim=True)).permute(1, 2, 0)
+
+            # one cost factor at a time, so only one (n_kernels, n_referents, n_rows) score block exists
+            for c, cost_factor in enumerate(cost_factors):
+                scores = speaker
+                if self.costs is not None and cost_factor:
+                    scores = speaker - cost_factor*self.costs[start:start + n_rows].view(1, 1, -1)
+
+                block_vals, block_idx = torch.topk(scores, min(k, n_rows), dim=2)
+                merged = torch.cat((top_vals[c], block_vals), 2)
+                top_vals[c], keep = torch.topk(merged, min(k, merged.shape[2]), dim=2)
+                top_idx[c] = torch.gather(torch.cat((top_idx[c], block_idx + start), 2), 2, keep)
+
+        settings = [{'penalty': p, 'subset': s, 'cost_factor': c}
+                    for (p, s), c in itertools.product(itertools.product(penalties, range(len(subsets))), cost_factors)]
+        # (n_kernels, n_cf, ...) order, same as settings
+        top_idx = torch.stack(top_idx, dim=1)
+        return settings, torch.reshape(top_idx, (n_kernels*n_cf, self.n_referents, -1))
+
+
+def agreement_report(settings, top_idx, reference=None, subsets=(None,)):
+    '''
+    Per setting: top-1 agreement with the reference best utterances & how often the
+    reference lands in the top-k (reference defaults to the first setting).
+    Only referents in the setting's subset are counted
+    '''
+    if reference is None:
+        reference = top_idx[0, :, 0]
+
+    report = []
+    for setting, top in zip(settings, top_idx):
+        referent_mask = torch.ones(top.shape[0], dtype=torch.bool)
+        if subsets[setting['subset']] is not None:
+            referent_mask = torch.zeros(top.shape[0], dtype=torch.bool)
+            referent_mask[subsets[setting['subset']]] = True
+
+        top1 = (top[:, 0] == reference)[referent_mask].float().mean().item()
+        topk = (top == reference.unsqueeze(1)).any(1)[referent_mask].float().mean().item()
+        report.append(dict(setting, top1_agreement=top1, topk_agreement=topk))
+    return report
+
+
+def retrieval_report(settings, top_idx, evaluate):
+    '''
+    Per setting: evaluate(best utterance index per referent) -> metrics dict, e.g. VI retrieval accuracy
+    '''
+    return [dict(setting, **evaluate(top[:, 0])) for setting, top in zip(settings, top_idx)]
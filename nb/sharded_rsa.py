@@ -0,0 +1,201 @@
+import os
+import argparse
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from RSA_helpers import *
+from rsa import RSA_CHUNK_SIZE
+
+
+
+### SHARDED RSA ###
+
+# Utterances are split into contiguous shards, one per worker (torch.distributed,
+# gloo backend - CPU only), and each shard is streamed in RSA_CHUNK_SIZE blocks,
+# so no worker ever holds more than (block, N_REFERENTS). The U bank is memory-
+# mapped and each worker only reads & normalizes its own rows; S_features and
+# the ontology kernel are memory-mapped too, so workers on one box share the
+# page cache instead of holding private copies. Utility and the pragmatic
+# speaker (normalized per utterance) are shard-local. Only two things are
+# exchanged: the literal listener's per-referent normalizers (one all_reduced
+# N-vector) and, at the end, the per-referent best score & index.
+#
+# Referents are deliberately not partitioned: utility mixes all referents
+# through the kernel and the speaker normalizes every utterance row over all
+# of them, so splitting referents too would mean exchanging per-utterance
+# (n_utterances-long) normalizers & partial utility blocks instead of N-vectors.
+# With ~10k referents the (block, N) working set & the N x N kernel stay small
+# next to the utterance bank, which is what actually gets split.
+
+def shard_bounds(n, rank, world_size):
+    per_shard = -(-n // world_size)
+    return min(rank*per_shard, n), min((rank + 1)*per_shard, n)
+
+
+def load_utterance_shard(U_path, rank=0, world_size=1):
+    '''
+    Normalized rows [lo, hi) of a raw U bank (e.g. U_features_raw.pt) & lo, hi.
+    The file is memory-mapped, so only this shard's rows are read
+    '''
+    U_flat = torch.load(U_path, mmap=True, weights_only=True)
+    U_flat = torch.reshape(U_flat, (-1, U_flat.shape[-1]))
+    lo, hi = shard_bounds(U_flat.shape[0], rank, world_size)
+    return torch.nn.functional.normalize(U_flat[lo:hi], dim=-1), lo, hi
+
+
+def _load_referents(S_path, kernel_path):
+    S_features = torch.load(S_path, mmap=True, weights_only=True)
+    kernel = torch.load(kernel_path, mmap=True, weights_only=True) if kernel_path else None
+    return S_features, kernel
+
+
+def _speaker_blocks(U_shard, S_features, lo, col_sums, kernel, chunk_size):
+    # pragmatic speaker for the shard's utterances (starting at global index lo), as in calculate_utility + pragmatic_speaker
+    for start in range(0, U_shard.shape[0], chunk_size):
+        listener = torch.nan_to_num(torch.nan_to_num(U_shard[start:start + chunk_size] @ S_features.T) / col_sums)
+        utility = listener @ kernel if kernel is not None else listener
+        yield lo + start, torch.nan_to_num(utility / torch.sum(utility, 1, keepdim=True))
+
+
+def _column_sums(U_shard, S_features, chunk_size):
+    col_sums = torch.zeros(S_features.shape[0])
+    for start in range(0, U_shard.shape[0], chunk_size):
+        col_sums += torch.nan_to_num(U_shard[start:start + chunk_size] @ S_features.T).sum(0)
+    return col_sums
+
+
+def _running_best(blocks, n_referents):
+    best_score = torch.full((n_referents,), -float('inf'))
+    best_idx = torch.zeros(n_referents, dtype=torch.long)
+    for start, speaker in blocks:
+        block_score, block_idx = torch.max(speaker, dim=0)
+        better = block_score > best_score
+        best_score = torch.where(better, block_score, best_score)
+        best_idx = torch.where(better, block_idx + start, best_idx)
+    return best_idx, best_score
+
+
+def run_shard(U_shard, S_features, lo, kernel=None, chunk_size=RSA_CHUNK_SIZE):
+    '''
+    RSA for this rank's utterances U_shard (global rows lo, lo+1, ...); every rank must call this together.
+    Returns this shard's best utterance index & score per referent
+    '''
+    # literal listener normalizers: local column sums, then one all_reduce
+    col_sums = _column_sums(U_shard, S_features, chunk_size)
+    dist.all_reduce(col_sums)
+
+    blocks = _speaker_blocks(U_shard, S_features, lo, col_sums, kernel, chunk_size)
+    return _running_best(blocks, S_features.shape[0])
+
+
+def reduce_best(best_idx, best_score):
+    '''
+    All-reduce per-referent (max score, argmax) across ranks; ties go to the lowest index, like torch.argmax
+    '''
+    global_score = best_score.clone()
+    dist.all_reduce(global_score, op=dist.ReduceOp.MAX)
+    global_idx = torch.where(best_score == global_score, best_idx, torch.iinfo(torch.long).max)
+    dist.all_reduce(global_idx, op=dist.ReduceOp.MIN)
+    return global_idx, global_score
+
+
+def _worker(rank, world_size, init_method, U_path, S_path, kernel_path, out_dir, chunk_size):
+    dist.init_process_group('gloo', init_method=init_method, rank=rank, world_size=world_size)
+
+    U_shard, lo, hi = load_utterance_shard(U_path, rank, world_size)
+    S_features, kernel = _load_referents(S_path, kernel_path)
+
+    best_idx, best_score = run_shard(U_shard, S_features, lo, kernel, chunk_size)
+    torch.save({'lo': lo, 'hi': hi, 'best_idx': best_idx, 'best_score': best_score},
+               os.path.join(out_dir, f'shard_{rank}.pt'))
+
+    best_idx, best_score = reduce_best(best_idx, best_score)
+    if rank == 0:
+        torch.save({'best_idx': best_idx, 'best_score': best_score}, os.path.join(out_dir, 'merged.pt'))
+    dist.destroy_process_group()
+
+
+def launch_local(world_size, U_path, S_path, out_dir, kernel_path=None, chunk_size=RSA_CHUNK_SIZE, port=29500):
+    '''
+    Run the sharded RSA on world_size local processes, writing shard_<rank>.pt files
+    (and the all_reduced merged.pt) to out_dir.
+    kernel_path: optional saved exp(-ONT_DIST_PENALTY*cross_ref_dists)
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    init_method = f'tcp://127.0.0.1:{port}'
+    mp.spawn(_worker, args=(world_size, init_method, U_path, S_path, kernel_path, out_dir, chunk_size),
+             nprocs=world_size, join=True)
+    return [os.path.join(out_dir, f'shard_{rank}.pt') for rank in range(world_size)]
+
+
+def merge_best(shard_paths):
+    '''
+    Per-referent best (index, score) over per-shard results, same tie-breaking as reduce_best
+    '''
+    shards = [torch.load(shard_path, weights_only=True) for shard_path in shard_paths]
+    scores = torch.stack([shard['best_score'] for shard in shards])
+    idx = torch.stack([shard['best_idx'] for shard in shards])
+    best_score = torch.max(scores, dim=0).values
+    best_idx = torch.where(scores == best_score, idx, torch.iinfo(torch.long).max).min(dim=0).values
+    return best_idx, best_score
+
+
+def to_mapping(best_idx, referents, referent_to_category, shape=(N_GRID_SEQ_TYPE,)*N_VOCAL_TRACT_CONTROLS):
+    locs = torch.stack(torch.unravel_index(best_idx, shape), dim=1)
+    return np.array([[referent_to_category[sample.split('.')[0]], '-'.join(map(str, loc.tolist()))]
+                     for sample, loc in zip(referents, locs)])
+
+
+def merge_shards(shard_paths, referents, referent_to_category, shape=(N_GRID_SEQ_TYPE,)*N_VOCAL_TRACT_CONTROLS):
+    '''
+    Merge per-shard results into the ref_ut_mapping format ([category, best_ID] per referent)
+    '''
+    return to_mapping(merge_best(shard_paths)[0], referents, referent_to_category, shape)
+
+
+def single_process_best(U_flat, S_features, kernel=None, chunk_size=RSA_CHUNK_SIZE):
+    '''
+    Reference (index, score) per referent from one process, same math as run_shard
+    '''
+    col_sums = _column_sums(U_flat, S_features, chunk_size)
+    blocks = _speaker_blocks(U_flat, S_features, 0, col_sums, kernel, chunk_size)
+    return _running_best(blocks, S_features.shape[0])
+
+
+def check_against_single_process(shard_paths, U_path, S_path, kernel_path=None, rtol=1e-5):
+    '''
+    Compare the merged sharded result with a single-process run. Indices may only differ
+    where the scores tie up to float summation order (col sums are added per shard)
+    '''
+    U_flat, _, _ = load_utterance_shard(U_path)
+    S_features, kernel = _load_referents(S_path, kernel_path)
+
+    sharded_idx, sharded_score = merge_best(shard_paths)
+    ref_idx, ref_score = single_process_best(U_flat, S_features, kernel)
+
+    same_idx = sharded_idx == ref_idx
+    close = torch.isclose(sharded_score, ref_score, rtol=rtol, atol=0)
+    if not torch.all(same_idx | close):
+        raise AssertionError(f"sharded RSA disagrees with single process on {int((~(same_idx | close)).sum())} referents")
+    return {'index_agreement': same_idx.float().mean().item(), 'max_score_diff': (sharded_score - ref_score).abs().max().item()}
+
+
+if __name__ == '__main__':
+    # e.g. python sharded_rsa.py -n 4 ../data/vocal_synth/U_features_raw.pt ../data/FSD50/eval_audio_features.pt ../data/FSD50/shards
+    parser = argparse.ArgumentParser(description='sharded RSA over local gloo workers')
+    parser.add_argument('U_path')
+    parser.add_argument('S_path')
+    parser.add_argument('out_dir')
+    parser.add_argument('-n', '--world-size', type=int, default=2)
+    parser.add_argument('--kernel', default=None)
+    parser.add_argument('--chunk-size', type=int, default=RSA_CHUNK_SIZE)
+    parser.add_argument('--port', type=int, default=29500)
+    parser.add_argument('--check', action='store_true', help='compare against a single-process run')
+    args = parser.parse_args()
+
+    paths = launch_local(args.world_size, args.U_path, args.S_path, args.out_dir, args.kernel, args.chunk_size, args.port)
+    print('wrote', *paths)
+    if args.check:
+        print('single-process check:', check_against_single_process(paths, args.U_path, args.S_path, args.kernel))
@@ -0,0 +1,142 @@
+import torch
+
+from RSA_helpers import *
+from rsa import RSA_CHUNK_SIZE, best_utterances
+
+
+
+### SPARSE MEANING ###
+
+# Almost none of the 161,051 x N_REFERENTS cosine scores matter for the final
+# argmax, so we keep only the top-k utterances per referent and the top-k
+# referents per utterance (union of both) as a coalesced COO tensor. Memory &
+# time then scale with k * (utterances + referents) instead of the full grid.
+
+def _sparse_topk(row_blocks, n_rows, n_cols, k_utterances, k_referents):
+    col_vals = torch.full((0, n_cols), -float('inf'))
+    col_idx = torch.zeros((0, n_cols), dtype=torch.long)
+    rows, cols, vals = [], [], []
+
+    for start, block in row_blocks:
+        block = torch.nan_to_num(block)
+
+        # top referents per utterance
+        top_vals, top = torch.topk(block, min(k_referents, n_cols), dim=1)
+        rows.append((torch.arange(block.shape[0]) + start).repeat_interleave(top.shape[1]))
+        cols.append(top.flatten())
+        vals.append(top_vals.flatten())
+
+        # running top utterances per referent
+        top_vals, top_rows = torch.topk(block, min(k_utterances, block.shape[0]), dim=0)
+        col_vals = torch.cat((col_vals, top_vals))
+        col_idx = torch.cat((col_idx, top_rows + start))
+        col_vals, keep = torch.topk(col_vals, min(k_utterances, col_vals.shape[0]), dim=0)
+        col_idx = torch.gather(col_idx, 0, keep)
+
+    rows.append(col_idx.flatten())
+    cols.append(torch.arange(n_cols).repeat(col_idx.shape[0]))
+    vals.append(col_vals.flatten())
+
+    # dedupe the union (duplicates come from the same block product, so share a value)
+    keys, inverse = torch.unique(torch.cat(rows)*n_cols + torch.cat(cols), return_inverse=True)
+    vals = torch.cat(vals)
+    unique_vals = torch.empty(keys.shape[0], dtype=vals.dtype).scatter_(0, inverse, vals)
+    return torch.sparse_coo_tensor(torch.stack((keys // n_cols, keys % n_cols)), unique_vals, (n_rows, n_cols)).coalesce()
+
+
+def sparsify_meaning(meaning, k_utterances=64, k_referents=8, chunk_size=RSA_CHUNK_SIZE):
+    '''
+    Sparsify a dense (utterances, referents) meaning matrix
+    '''
+    n_rows, n_cols = meaning.shape
+    blocks = ((s, meaning[s:s + chunk_size]) for s in range(0, n_rows, chunk_size))
+    return _sparse_topk(blocks, n_rows, n_cols, k_utterances, k_referents)
+
+
+def sparse_meaning_from_features(U_flat, S_features, k_utterances=64, k_referents=8, chunk_size=RSA_CHUNK_SIZE):
+    '''
+    Build the sparse meaning matrix straight from (utterances, feats) & (referents, feats)
+    feature banks, never materializing the dense matrix
+    '''
+    n_rows, n_cols = U_flat.shape[0], S_features.shape[0]
+    blocks = ((s, U_flat[s:s + chunk_size] @ S_features.T) for s in range(0, n_rows, chunk_size))
+    return _sparse_topk(blocks, n_rows, n_cols, k_utterances, k_referents)
+
+
+### SPARSE RSA ###
+
+def _normalize_values(vals, index, n):
+    sums = torch.zeros(n, dtype=vals.dtype).index_add_(0, index, vals)
+    return torch.nan_to_num(vals / sums[index])
+
+
+def sparse_utility(listener, kernel, chunk_size=RSA_CHUNK_SIZE):
+    '''
+    (listener @ kernel) evaluated on listener's sparsity pattern only, chunked over utterance rows
+    '''
+    rows, cols = listener.indices()
+    vals = listener.values()
+    n_rows, n_cols = listener.shape
+    utility = torch.empty_like(vals)
+
+    for start in range(0, n_rows, chunk_size):
+        lo, hi = torch.searchsorted(rows, torch.tensor([start, start + chunk_size])).tolist()
+        if lo == hi:
+            continue
+        block_idx = torch.stack((rows[lo:hi] - start, cols[lo:hi]))
+        block = torch.sparse_coo_tensor(block_idx, vals[lo:hi], (min(chunk_size, n_rows - start), n_cols))
+        utility[lo:hi] = torch.sparse.mm(block, kernel)[block_idx[0], block_idx[1]]
+
+    return torch.sparse_coo_tensor(listener.indices(), utility, listener.shape).coalesce()
+
+
+def sparse_rsa(meaning, kernel=None, chunk_size=RSA_CHUNK_SIZE):
+    '''
+    Literal listener -> (utility) -> pragmatic speaker on a sparse meaning matrix,
+    normalized along the same axes as the notebooks
+    '''
+    rows, cols = meaning.indices()
+    n_rows, n_cols = meaning.shape
+
+    vals = _normalize_values(meaning.values(), cols, n_cols)
+    literal_listener = torch.sparse_coo_tensor(meaning.indices(), vals, meaning.shape).coalesce()
+
+    if kernel is not None:
+        literal_listener = sparse_utility(literal_listener, kernel, chunk_size)
+
+    vals = _normalize_values(literal_listener.values(), rows, n_rows)
+    return torch.sparse_coo_tensor(meaning.indices(), vals, meaning.shape).coalesce()
+
+
+def sparse_best_utterances(speaker, shape=(N_GRID_SEQ_TYPE,)*N_VOCAL_TRACT_CONTROLS):
+    '''
+    Best utterance ID per referent (ties go to the lowest index, like torch.argmax)
+    '''
+    rows, cols = speaker.indices()
+    vals = speaker.values()
+    n_cols = speaker.shape[1]
+
+    col_max = torch.full((n_cols,), -float('inf'), dtype=vals.dtype).scatter_reduce_(0, cols, vals, 'amax')
+    hit = vals == col_max[cols]
+    best = torch.full((n_cols,), speaker.shape[0], dtype=torch.long).scatter_reduce_(0, cols[hit], rows[hit], 'amin')
+
+    locs = torch.stack(torch.unravel_index(best, shape), dim=1)
+    return ['-'.join(map(str, loc.tolist())) for loc in locs]
+
+
+def compare_to_dense(meaning, kernel=None, k_utterances=64, k_referents=8):
+    '''
+    Agreement rate of the sparse best utterances vs. the dense run (notebook RSA)
+    '''
+    sparse = sparsify_meaning(meaning, k_utterances, k_referents)
+    sparse_best = sparse_best_utterances(sparse_rsa(sparse, kernel))
+
+    literal_listener = torch.nan_to_num(meaning / torch.sum(meaning, 0, keepdim=True))
+    utility = literal_listener @ kernel if kernel is not None else literal_listener
+    dense_best = best_utterances(torch.nan_to_num(utility / torch.sum(utility, 1, keepdim=True)))
+
+    return {
+        'agreement': sum(a == b for a, b in zip(sparse_best, dense_best)) / len(dense_best),
+        'nnz': sparse.values().shape[0],
+        'density': sparse.values().shape[0] / (meaning.shape[0]*meaning.shape[1]),
+    }
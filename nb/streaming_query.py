@@ -0,0 +1,215 @@
+import time
+import math
+import torch
+import torch.nn.functional as F
+import torchaudio.transforms as T
+
+from RSA_helpers import *
+from retrieval_eval import category_groups, category_marginals
+
+
+
+### STREAMING QUERY ###
+
+# Instead of waiting for the whole recording, we compute STFT frames as soon as
+# their window is complete (same framing as SimpleAudioFeatures: centered,
+# reflect-padded, hop = FEAT_NFFT//2) and keep the per-frame loudness /
+# flatness / centroid / peak tracks. The summary features are only FEAT_LEN
+# long, so re-deriving them after every chunk is cheap. While the clip is
+# shorter than SAMPLE_LEN/CONTROL_SR seconds the available frames are tiled,
+# like repeat((1,5)) does for one-shots in the batch extractor.
+#
+# Input at another sample rate is resampled incrementally (_StreamingResampler):
+# we keep the raw samples the sinc kernel still needs and only emit output that
+# no future input can change, so chunk boundaries leave no edge artifacts and
+# the result matches resampling the whole clip at once.
+
+class _StreamingResampler(object):
+    '''
+    Incremental T.Resample: same kernel & output as resampling the concatenated input in one go
+    '''
+    def __init__(self, orig_sr, new_sr):
+        self.resampler = T.Resample(orig_sr, new_sr)
+        gcd = math.gcd(int(orig_sr), int(new_sr))
+        self.orig, self.new = int(orig_sr) // gcd, int(new_sr) // gcd
+        self.width = self.resampler.width
+        self.kernel = self.resampler.kernel
+        self.reset()
+
+    def reset(self):
+        self.raw = torch.zeros(0)
+        self.raw_start = 0   # absolute input index of raw[0]
+        self.n_raw = 0       # input samples seen
+        self.next_block = 0  # next block of `new` output samples to emit
+
+    def push(self, chunk):
+        self.raw = torch.cat((self.raw, chunk))
+        self.n_raw += chunk.shape[0]
+        # output block b reads input [b*orig - width, (b+1)*orig + width)
+        end_block = max((self.n_raw - self.width) // self.orig, self.next_block)
+        return self._emit(end_block)
+
+    def finish(self):
+        '''
+        Zero-pad the right edge like T.Resample & return the remaining output
+        '''
+        n_out = math.ceil(self.new*self.n_raw / self.orig)
+        end_block = -(-n_out // self.new)
+        self.raw = torch.cat((self.raw, torch.zeros(max(end_block*self.orig + self.width - self.n_raw, 0))))
+        out = self._emit(end_block)
+        return out[:max(n_out - (end_block*self.new - out.shape[0]), 0)]
+
+    def _emit(self, end_block):
+        if end_block <= self.next_block:
+            return torch.zeros(0)
+        lo = self.next_block*self.orig - self.width
+        hi = end_block*self.orig + self.width
+        seg = self.raw[max(lo, 0) - self.raw_start:hi - self.raw_start]
+        if lo < 0:
+            # zero padding at the clip start, as in T.Resample
+            seg = torch.cat((torch.zeros(-lo), seg))
+
+        out = F.conv1d(seg.view(1, 1, -1), self.kernel.to(seg), stride=self.orig)
+        out = out.transpose(1, 2).reshape(-1)
+
+        # drop raw samples no later block needs
+        self.next_block = end_block
+        keep_from = max(self.next_block*self.orig - self.width, 0)
+        self.raw = self.raw[keep_from - self.raw_start:]
+        self.raw_start = keep_from
+        return out
+
+
+class StreamingImitationQuery(object):
+    '''
+    Incremental vocal imitation -> referent retrieval.
+
+    bank_features: (n, feats) normalized features to rank against (e.g. S_features)
+    bank_labels: label per bank row (e.g. referent categories)
+    '''
+    def __init__(self, bank_features, bank_labels, sr=AUDIO_SR, top_k=10, ont_tree=None, tree_level=1):
+        self.bank_features = bank_features
+        self.bank_labels = list(bank_labels)
+        self.top_k = top_k
+        self.resampler = _StreamingResampler(sr, AUDIO_SR) if sr != AUDIO_SR else None
+
+        self.n_fft = FEAT_NFFT
+        self.hop = FEAT_NFFT // 2
+        self.pad = FEAT_NFFT // 2
+        self.max_samples = AUDIO_SR*SAMPLE_LEN//CONTROL_SR
+        self.window = torch.hann_window(self.n_fft)
+        self.freqs = torch.linspace(0, AUDIO_SR // 2, steps=1 + self.n_fft // 2).unsqueeze(1)
+
+        # category of each bank label at tree_level, looked up once
+        self.label_groups = category_groups(ont_tree, self.bank_labels, tree_level) if ont_tree is not None else None
+
+        self.reset()
+
+    def reset(self):
+        self.buffer = torch.zeros(self.max_samples)
+        self.n_samples = 0
+        self.n_frames = 0
+        self.tracks = torch.zeros((4, FEAT_LEN))   # loudness, flatness, centroid, peak
+        self.ranking = None
+        self.ended = False
+        if self.resampler is not None:
+            self.resampler.reset()
+
+    @property
+    def done(self):
+        return self.n_frames == FEAT_LEN or self.ended
+
+    def push(self, chunk):
+        '''
+        Add a chunk of mono audio & return the refreshed ranking
+        '''
+        start_time = time.perf_counter()
+        chunk = torch.as_tensor(chunk, dtype=torch.float).flatten()
+        if self.resampler is not None:
+            chunk = self.resampler.push(chunk)
+        return self._ingest(chunk, start_time)
+
+    def finish(self):
+        '''
+        End of the imitation: flush the resampler & compute the last (reflect-padded) frames
+        '''
+        start_time = time.perf_counter()
+        chunk = self.resampler.finish() if self.resampler is not None else torch.zeros(0)
+        self.ended = True
+        return self._ingest(chunk, start_time)
+
+    def _ingest(self, chunk, start_time):
+        n_new = min(chunk.shape[0], self.max_samples - self.n_samples)
+        self.buffer[self.n_samples:self.n_samples + n_new] = chunk[:n_new]
+        self.n_samples += n_new
+
+        self._update_frames()
+        self.ranking = self.rank()
+        self.ranking['latency_ms'] = (time.perf_counter() - start_time)*1000
+        return self.ranking
+
+    def _update_frames(self):
+        # frames whose window lies within the buffer, or all of them once the clip is over
+        if self.n_samples >= self.max_samples:
+            last = FEAT_LEN
+        elif self.ended and self.n_samples > self.pad:
+            last = min(self.n_samples // self.hop + 1, FEAT_LEN)
+        elif self.n_samples > self.pad:
+            last = min((self.n_samples - self.pad) // self.hop + 1, FEAT_LEN)
+        else:
+            last = 0
+        if last <= self.n_frames:
+            return
+
+        first = self.n_frames
+        start, end = first*self.hop - self.pad, (last - 1)*self.hop + self.pad
+        seg = self.buffer[max(start, 0):min(end, self.n_samples)]
+
+        # reflect padding at the clip edges (reflect of the *whole* clip, so we can't F.pad the slice)
+        if start < 0:
+            seg = torch.cat((self.buffer[1:1 - start].flip(0), seg))
+        if end > self.n_samples:
+            seg = torch.cat((seg, self.buffer[self.n_samples - 1 - (end - self.n_samples):self.n_samples - 1].flip(0)))
+
+        mag = torch.stft(seg, self.n_fft, self.hop, window=self.window, center=False, return_complex=True).abs()
+        power = mag**2
+
+        self.tracks[0, first:last] = torch.sum(power, 0)
+        self.tracks[1, first:last] = spec_flatness_from_spectrogram(power, dim=0)
+        self.tracks[2, first:last] = torch.nan_to_num(torch.sum(self.freqs*mag, 0) / torch.sum(mag, 0))
+        self.tracks[3, first:last] = torch.argmax(power, dim=0).float()
+        self.n_frames = last
+
+    def features(self):
+        '''
+        Current normalized feature vector (same layout as SimpleAudioFeatures), or None before the first frame
+        '''
+        if self.n_frames == 0:
+            return None
+        loudness, flatness, centroid, peak = self.tracks[:, torch.arange(FEAT_LEN) % self.n_frames]
+
+        loudness_f = compute_dist_features(trap_win_1D(F.normalize(loudness, dim=0)) * 600, include_mean=False)
+        flatness_f = compute_dist_features(trap_win_1D(flatness) * 2 * 10**5)
+        centroid_f = compute_dist_features(trap_win_1D(centroid) / AUDIO_SR * 3000)
+        peak_f = compute_dist_features(trap_win_1D(peak) * 3)
+
+        features = torch.cat((loudness_f, flatness_f, centroid_f, peak_f)).float()
+        return F.normalize(torch.nan_to_num(features), dim=0)
+
+    def rank(self):
+        '''
+        Top-k bank entries (and marginal probabilities of their categories, if we have an ontology)
+        '''
+        features = self.features()
+        if features is None:
+            return {'top': [], 'categories': {}, 'n_frames': 0}
+
+        sims = torch.nan_to_num(self.bank_features @ features)
+        top_sims, top_idx = torch.topk(sims, min(self.top_k, sims.shape[0]))
+        top = [(self.bank_labels[i], s) for i, s in zip(top_idx.tolist(), top_sims.tolist())]
+
+        categories = {}
+        if self.label_groups is not None:
+            categories = category_marginals(self.label_groups, top_idx.tolist(), top_sims.tolist())
+
+        return {'top': top, 'categories': categories, 'n_frames': self.n_frames}
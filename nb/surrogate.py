@@ -0,0 +1,140 @@
+import torch
+import itertools
+import torch.nn.functional as F
+from torch import nn
+
+from RSA_helpers import *
+
+
+
+### GLOBALS ###
+SURROGATE_HIDDEN = 512
+SURROGATE_BATCH = 1024
+SURROGATE_LR = 1e-3
+
+
+### SURROGATE ###
+
+# Rendering + featurizing one utterance through the Faust DSP costs tens of ms,
+# so we learn the (SAMPLE_LEN, N_VOCAL_TRACT_CONTROLS) -> feature vector map
+# from the grid we've already rendered & use it to screen unrendered sequences.
+#
+# NOTE: the random grid sequence type (10) is seeded per grid point
+# (grid_control_sequence, control_seed), same as UtteranceSpace(seed=control_seed)
+# renders it. The existing U_features bank was rendered with unseeded draws
+# though, so for the ~38% of grid points with a random control its rows don't
+# match the controls we'd feed in. Those points are left out of training &
+# holdout unless the bank was rendered with seeded controls (exclude_random=False).
+
+class SurrogateFeatureModel(nn.Module):
+    '''
+    Small MLP predicting (normalized) utterance features from a control matrix
+    '''
+    def __init__(self, hidden=SURROGATE_HIDDEN):
+        super().__init__()
+        self.net = nn.Sequential(
+            nn.Linear(SAMPLE_LEN*N_VOCAL_TRACT_CONTROLS, hidden),
+            nn.GELU(),
+            nn.Linear(hidden, hidden),
+            nn.GELU(),
+            nn.Linear(hidden, FEAT_LEN*N_AUDIO_FEATURES),
+        )
+
+    def forward(self, controls: torch.Tensor) -> torch.Tensor:
+        # controls: (batch, SAMPLE_LEN, N_VOCAL_TRACT_CONTROLS), centered around 0
+        x = torch.reshape(controls - 0.5, (controls.shape[0], -1))
+        return F.normalize(self.net(x), dim=-1)
+
+
+def grid_indices(n_seq_types=N_GRID_SEQ_TYPE):
+    '''
+    (n_seq_types**N_VOCAL_TRACT_CONTROLS, N_VOCAL_TRACT_CONTROLS) tensor of all grid points,
+    in the same (row-major) order as U_features.reshape(-1, FEAT_LEN*N_AUDIO_FEATURES)
+    '''
+    return torch.tensor(list(itertools.product(range(n_seq_types), repeat=N_VOCAL_TRACT_CONTROLS)))
+
+
+def train_surrogate(U_features, n_epochs=10, holdout=0.05, seed=0, model=None, verbose=True,
+                    control_seed=0, exclude_random=True):
+    '''
+    Fit a surrogate on the grid feature bank U_features, shape (N_GRID_SEQ_TYPE,)*N_VOCAL_TRACT_CONTROLS + (feats,).
+    seed drives init & shuffling, control_seed the random sequence type (match UtteranceSpace's seed).
+    exclude_random: skip grid points with a random control (their U_features rows came from unseeded draws).
+    Returns the model & the flat indices of the held-out grid points; for calibration_report:
+    grid_control_sequences(grid_indices()[held_out], held_out, control_seed) & U_features.reshape(-1, feats)[held_out]
+    '''
+    torch.manual_seed(seed)
+    targets = F.normalize(torch.reshape(U_features, (-1, FEAT_LEN*N_AUDIO_FEATURES)).float(), dim=-1)
+    targets = torch.nan_to_num(targets)
+    idx = grid_indices(U_features.shape[0])
+
+    rows = torch.arange(idx.shape[0])
+    if exclude_random:
+        rows = rows[~(idx == N_GRID_SEQ_TYPE - 1).any(1)]
+    perm = rows[torch.randperm(rows.shape[0])]
+    n_holdout = int(holdout*perm.shape[0])
+    test_rows, train_rows = perm[:n_holdout], perm[n_holdout:]
+
+    if model is None:
+        model = SurrogateFeatureModel()
+    optimizer = torch.optim.Adam(model.parameters(), lr=SURROGATE_LR)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, n_epochs)
+
+    model.train()
+    for epoch in range(n_epochs):
+        epoch_rows = train_rows[torch.randperm(train_rows.shape[0])]
+        total_loss = 0.0
+        for batch_rows in torch.split(epoch_rows, SURROGATE_BATCH):
+            pred = model(grid_control_sequences(idx[batch_rows], batch_rows, control_seed))
+            true = targets[batch_rows]
+            # cosine drives retrieval, mse keeps individual dims calibrated
+            loss = (1 - torch.sum(pred*true, -1)).mean() + F.mse_loss(pred, true)*FEAT_LEN
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total_loss += loss.item()*batch_rows.shape[0]
+        scheduler.step()
+
+        if verbose:
+            print(f"epoch {epoch}: loss {total_loss/train_rows.shape[0]:.4f}")
+
+    model.eval()
+    return model, test_rows
+
+
+@torch.no_grad()
+def predict_features(model, controls, batch_size=16384):
+    '''
+    Predict normalized features for (n, SAMPLE_LEN, N_VOCAL_TRACT_CONTROLS) control sequences in large batches
+    '''
+    model.eval()
+    return torch.cat([model(batch) for batch in torch.split(controls, batch_size)])
+
+
+@torch.no_grad()
+def calibration_report(model, controls, true_features, S_features=None, k=10):
+    '''
+    Compare surrogate predictions against features of true renders.
+    If a referent bank S_features is given, also report how often the surrogate
+    picks the same best referent (and lands in the true top-k)
+    '''
+    pred = predict_features(model, controls)
+    true = torch.nan_to_num(F.normalize(true_features.float(), dim=-1))
+
+    cos = torch.sum(pred*true, -1)
+    report = {
+        'n': pred.shape[0],
+        'cosine_mean': cos.mean().item(),
+        'cosine_p05': torch.quantile(cos, 0.05).item(),
+        'mse': F.mse_loss(pred, true).item(),
+        'rel_err': (torch.linalg.vector_norm(pred - true, dim=-1) / torch.linalg.vector_norm(true, dim=-1).clamp_min(1e-12)).mean().item(),
+    }
+
+    if S_features is not None:
+        pred_best = torch.argmax(pred @ S_features.T, dim=-1)
+        true_top = torch.topk(true @ S_features.T, k, dim=-1).indices
+        report['referent_top1_agreement'] = (pred_best == true_top[:, 0]).float().mean().item()
+        report[f'referent_top{k}_hit'] = (true_top == pred_best.unsqueeze(1)).any(-1).float().mean().item()
+
+    return report
@@ -0,0 +1,243 @@
+import os
+import numpy as np
+import torch
+import torchaudio
+from collections import OrderedDict
+
+from RSA_helpers import *
+
+
+
+### SYNTHESIS ###
+
+# control column -> (DSP ui parameter, value transform), same as in SF_data_gen.
+# A DSP with more sliders gets more columns, e.g. VOCAL_TRACT_ZONES + (('b_vocal.p_breath', float),)
+VOCAL_TRACT_ZONES = (
+    ('b_vocal.p_freq', lambda x: x + 0.01*np.random.rand()),
+    ('b_vocal.p_gain', lambda x: x),
+    ('b_vocal.p_vowel', lambda x: x + 0.02*np.random.rand()),
+    ('b_vocal.p_fricative', lambda x: x > 0.99),
+    ('b_vocal.p_plosive', lambda x: x > 0.2),
+)
+
+
+def resolve_zones(dsp, control_zones):
+    '''
+    ui parameter objects for 'group.param' paths, e.g. 'b_vocal.p_freq' -> dsp.ui.b_vocal.p_freq
+    '''
+    params = []
+    for zone_path, _ in control_zones:
+        param = dsp.ui
+        for name in zone_path.split('.'):
+            param = getattr(param, name)
+        params.append(param)
+    return params
+
+
+def synthesize_voice(dsp, params_sequence, control_zones=VOCAL_TRACT_ZONES):
+    '''
+    Render a (n_control_steps, len(control_zones)) control sequence with a Faust vocal synth (same as in SF_data_gen)
+    '''
+    n_control_steps, n_controls = params_sequence.shape
+    if n_controls != len(control_zones):
+        raise ValueError(f"{n_controls} control columns for {len(control_zones)} DSP zones")
+    params = resolve_zones(dsp, control_zones)
+    output = np.zeros(n_control_steps*AUDIO_SR//CONTROL_SR, dtype=np.float32)
+
+    # warm-up
+    dsp.proc.compute(500)
+
+    for i in range(n_control_steps):
+        for j, (param, (_, transform)) in enumerate(zip(params, control_zones)):
+            param.zone = transform(params_sequence[i, j].item())
+        output[i*AUDIO_SR//CONTROL_SR : (i+1)*AUDIO_SR//CONTROL_SR] = dsp.proc.compute(AUDIO_SR//CONTROL_SR)
+
+    return torch.tensor(output)
+
+
+### UTTERANCE SPACE ###
+
+class UtteranceSpace(object):
+    '''
+    Lazy grid of utterances, rendered & featurized on first access.
+
+    Grid points are addressed by a mixed-radix index (control i takes radices[i]
+    sequence types, last control varies fastest - same order as
+    itertools.product & U_features.reshape), by control tuple (4,7,6,4,8) or by
+    ID string '4-7-6-4-8'. Audio & features are kept in bounded LRU caches in
+    memory and on disk (as <ID>.wav, like VOCAL_DATA_DIR, and features/<ID>.pt).
+
+    Bigger grids plug in a sequence-type table & a control -> DSP zone mapping, e.g.
+    15 types: seq_fn=lookup_extended_grid_seq, n_seq_types=N_EXTENDED_SEQ_TYPE.
+    radices defaults to (n_seq_types,)*len(control_zones).
+    The feature cache isn't keyed by extractor - use a separate cache_dir per extractor.
+    '''
+    def __init__(self, dsp, cache_dir, radices=None, prerendered_dir=None, max_memory_items=256,
+                 max_disk_items=20_000, feature_extractor=None, seed=0,
+                 seq_fn=lookup_grid_seq, n_seq_types=N_GRID_SEQ_TYPE, control_zones=VOCAL_TRACT_ZONES):
+        self.dsp = dsp
+        self.cache_dir = cache_dir
+        self.feature_dir = os.path.join(cache_dir, 'features')
+        self.prerendered_dir = prerendered_dir
+        self.seq_fn = seq_fn
+        self.control_zones = tuple(control_zones)
+        self.radices = tuple(radices) if radices is not None else (n_seq_types,)*len(self.control_zones)
+        if len(self.radices) != len(self.control_zones):
+            raise ValueError(f"{len(self.radices)} radices for {len(self.control_zones)} controls (control_zones)")
+        if any(r > n_seq_types for r in self.radices):
+            raise ValueError(f"only {n_seq_types} grid sequence types are defined (seq_fn), got radices {self.radices}")
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        self.feature_extractor = feature_extractor if feature_extractor is not None else SimpleAudioFeatures()
+        self.seed = seed
+
+        # strides for the mixed-radix index
+        self.strides = [1]*len(self.radices)
+        for i in range(len(self.radices) - 2, -1, -1):
+            self.strides[i] = self.strides[i + 1]*self.radices[i + 1]
+
+        self._audio = OrderedDict()
+        self._features = OrderedDict()
+
+        # resume the disk caches, oldest first
+        self._disk = self._resume(cache_dir, '.wav')
+        self._disk_features = self._resume(self.feature_dir, '.pt')
+
+    def __len__(self):
+        return self.strides[0]*self.radices[0]
+
+    # indexing
+
+    def to_tuple(self, key):
+        '''
+        Grid point (flat index, tuple or ID string) -> control tuple
+        '''
+        if isinstance(key, str):
+            tup = tuple(int(x) for x in key.split('-'))
+        elif isinstance(key, (int, np.integer)) or (torch.is_tensor(key) and key.ndim == 0):
+            key = int(key)
+            if not 0 <= key < len(self):
+                raise IndexError(f"utterance index {key} out of range for {len(self)} grid points")
+            tup = tuple((key // s) % r for s, r in zip(self.strides, self.radices))
+        else:
+            tup = tuple(int(x) for x in key)
+
+        if len(tup) != len(self.radices) or any(not 0 <= x < r for x, r in zip(tup, self.radices)):
+            raise IndexError(f"invalid grid point {tup} for radices {self.radices}")
+        return tup
+
+    def to_index(self, key):
+        return sum(x*s for x, s in zip(self.to_tuple(key), self.strides))
+
+    def to_id(self, key):
+        return '-'.join(map(str, self.to_tuple(key)))
+
+    def controls(self, key):
+        '''
+        (SAMPLE_LEN, n_controls) control matrix; same seeding as the surrogate's training controls
+        '''
+        tup = self.to_tuple(key)
+        return grid_control_sequence(tup, self.to_index(tup), self.seed, self.seq_fn)
+
+    # cached access
+
+    def path(self, key):
+        '''
+        Path to the utterance's wav, rendering it first if needed - drop-in for VOCAL_DATA_DIR + best_ID + '.wav'
+        '''
+        utterance_id = self.to_id(key)
+        cached = self._cached_path(utterance_id)
+        if cached is None:
+            # rendering in audio() writes the disk cache; only a memory hit can skip it
+            waveform = self.audio(utterance_id)
+            cached = self._cached_path(utterance_id) or self._save(utterance_id, waveform)
+        return cached
+
+    def audio(self, key):
+        '''
+        1D waveform at AUDIO_SR
+        '''
+        utterance_id = self.to_id(key)
+        if utterance_id in self._audio:
+            self._audio.move_to_end(utterance_id)
+            return self._audio[utterance_id]
+
+        cached = self._cached_path(utterance_id)
+        if cached is not None:
+            waveform = torchaudio.load(cached)[0][0, :]
+        else:
+            waveform = synthesize_voice(self.dsp, self.controls(utterance_id), self.control_zones)
+            self._save(utterance_id, waveform)
+
+        self._touch(self._audio, utterance_id, waveform, self.max_memory_items)
+        return waveform
+
+    def features(self, key):
+        '''
+        Raw (unnormalized) feature vector, like U_features_raw.pt entries
+        '''
+        utterance_id = self.to_id(key)
+        if utterance_id in self._features:
+            self._features.move_to_end(utterance_id)
+            return self._features[utterance_id]
+
+        cached = os.path.join(self.feature_dir, utterance_id + '.pt')
+        if utterance_id in self._disk_features and os.path.isfile(cached):
+            self._disk_features.move_to_end(utterance_id)
+            feature_vector = torch.load(cached, weights_only=True)
+        else:
+            with torch.no_grad():
+                feature_vector = torch.reshape(self.feature_extractor(self.audio(utterance_id)), (-1,))
+            torch.save(feature_vector, cached)
+            self._touch(self._disk_features, utterance_id, None, self.max_disk_items, self._evict_feature_file)
+
+        self._touch(self._features, utterance_id, feature_vector, self.max_memory_items)
+        return feature_vector
+
+    def features_batch(self, keys):
+        return torch.stack([self.features(k) for k in keys])
+
+    def __getitem__(self, key):
+        return self.features(key)
+
+    def _resume(self, directory, ext):
+        os.makedirs(directory, exist_ok=True)
+        cached = [f for f in os.listdir(directory) if f.endswith(ext)]
+        cached.sort(key=lambda f: os.path.getmtime(os.path.join(directory, f)))
+        return OrderedDict((f[:-len(ext)], None) for f in cached)
+
+    def _cached_path(self, utterance_id):
+        if self.prerendered_dir is not None:
+            prerendered = os.path.join(self.prerendered_dir, utterance_id + '.wav')
+            if os.path.isfile(prerendered):
+                return prerendered
+
+        cached = os.path.join(self.cache_dir, utterance_id + '.wav')
+        if utterance_id in self._disk and os.path.isfile(cached):
+            self._disk.move_to_end(utterance_id)
+            return cached
+        return None
+
+    def _save(self, utterance_id, waveform):
+        cached = os.path.join(self.cache_dir, utterance_id + '.wav')
+        torchaudio.save(cached, waveform.unsqueeze(0), sample_rate=AUDIO_SR)
+        self._touch(self._disk, utterance_id, None, self.max_disk_items, self._evict_file)
+        return cached
+
+    def _touch(self, cache, utterance_id, value, max_items, on_evict=None):
+        cache[utterance_id] = value
+        cache.move_to_end(utterance_id)
+        while len(cache) > max_items:
+            evicted_id, _ = cache.popitem(last=False)
+            if on_evict is not None:
+                on_evict(evicted_id)
+
+    def _evict_file(self, utterance_id):
+        evicted = os.path.join(self.cache_dir, utterance_id + '.wav')
+        if os.path.isfile(evicted):
+            os.remove(evicted)
+
+    def _evict_feature_file(self, utterance_id):
+        evicted = os.path.join(self.feature_dir, utterance_id + '.pt')
+        if os.path.isfile(evicted):
+            os.remove(evicted)